@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency and throughput benchmark
+
+Drives the real MQTT_CUL_Server against a virtual CUL on a pseudo-terminal
+and an in-process stand-in for the MQTT client. Measures
+
+- Somfy and Intertechno: time from MQTT_CUL_Server.on_mqtt_message to the
+  frame arriving at the virtual CUL, i.e. after it was flushed. Throughput
+  counts frames actually sent; Somfy commands replaced by a newer command
+  for the same device before they were sent are counted as coalesced
+- LaCrosse: time from writing an RF line to the virtual CUL to the state
+  message being published
+
+Each path is measured with paced messages for p50/p99 latency and with
+back-to-back messages for the maximum sustained throughput. Run with:
+
+    python benchmarks/e2e.py [--count 500] [--rate 20]
+"""
+
+import argparse
+import collections
+import configparser
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from mqtt_cul_server import MQTT_CUL_Server  # noqa: E402
+from mqtt_cul_server.protocols.lacrosse import CRC_TABLE  # noqa: E402
+from mqtt_cul_server.testing import write_somfy_state  # noqa: E402
+
+PREFIX = "homeassistant"
+SYSTEM_ID = "0F0FF"
+SOMFY_ADDRESSES = ["B0C0%02X" % i for i in range(20)]
+
+
+class FakeCul:
+    """Virtual CUL on a pseudo-terminal, timestamping each received frame"""
+
+    def __init__(self):
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        self.frames = collections.defaultdict(list)
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        buffer = b""
+        while True:
+            buffer += os.read(self.master, 4096)
+            now = time.perf_counter()
+            *lines, buffer = buffer.split(b"\n")
+            with self.condition:
+                for line in lines:
+                    self.frames[line[0:2]].append(now)
+                self.condition.notify_all()
+
+    def wait_frames(self, prefix, count, timeout=60):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.frames[prefix]) >= count, timeout)
+            return list(self.frames[prefix])
+
+    def wait_idle(self, prefix, quiet=0.5, timeout=60):
+        """Wait until no frames arrived for quiet seconds, return all frames"""
+        deadline = time.perf_counter() + timeout
+        with self.condition:
+            count = -1
+            while count != len(self.frames[prefix]) and time.perf_counter() < deadline:
+                count = len(self.frames[prefix])
+                self.condition.wait(quiet)
+            return list(self.frames[prefix])
+
+    def send_rf(self, line):
+        os.write(self.master, line + b"\r\n")
+
+
+class FakeMqttClient:
+    """Stand-in for the paho client, timestamping each published message"""
+
+    def __init__(self):
+        self.published = collections.defaultdict(list)
+        self.condition = threading.Condition()
+
+    def is_connected(self):
+        return True
+
+    def subscribe(self, *_args, **_kwargs):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        now = time.perf_counter()
+        with self.condition:
+            self.published[topic].append((now, payload))
+            self.condition.notify_all()
+
+    def wait_published(self, topic, count, timeout=60):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.published[topic]) >= count, timeout)
+            return list(self.published[topic])
+
+
+class BenchmarkServer(MQTT_CUL_Server):
+    def get_mqtt_client(self, mqtt_config):
+        return FakeMqttClient()
+
+
+def lacrosse_frame(sensor_id, temperature):
+    """Build a valid LaCrosse RF line for a sensor id and temperature"""
+    data = "9%02X%03d%02X" % (sensor_id << 2, round((temperature + 40) * 10), 50)
+    crc = 0
+    for byte in bytes.fromhex(data):
+        crc = CRC_TABLE[crc ^ byte]
+    return ("N01%s%02XAAAA0000000000" % (data, crc)).encode()
+
+
+def make_config(port, statedir):
+    for address in SOMFY_ADDRESSES:
+        write_somfy_state(statedir, address, rolling_code=0, enc_key=0)
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "DEFAULT": {"CUL": port, "baud_rate": "115200", "statedir": statedir, "prefix": PREFIX},
+        "mqtt": {"host": "localhost", "port": "1883"},
+        "intertechno": {"enabled": "yes", "system_id": SYSTEM_ID},
+        "somfy": {"enabled": "yes"},
+        "lacrosse": {"enabled": "yes", "heartbeat": "0"},
+    })
+    return config
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies, count, duration, coalesced=0):
+    """Print latency percentiles, and count per second as throughput"""
+    print("%-12s %6d %10.2f %10.2f %12.0f %10d" % (
+        name, len(latencies),
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        count / duration, coalesced,
+    ))
+
+
+def bench_command(server, fake_cul, name, prefix, messages, count, rate):
+    """Measure MQTT command to serial frame latency and throughput"""
+    start = len(fake_cul.frames[prefix])
+    sent = []
+    for i in range(count):
+        msg = messages[i % len(messages)]
+        sent.append(time.perf_counter())
+        server.on_mqtt_message(None, None, msg)
+        time.sleep(1 / rate)
+    frames = fake_cul.wait_frames(prefix, start + count)[start:]
+    latencies = [received - t for t, received in zip(sent, frames)]
+
+    # back-to-back commands for the same device may be coalesced into one
+    # frame, so wait until frames stop arriving
+    start = len(fake_cul.frames[prefix])
+    t0 = time.perf_counter()
+    for i in range(count):
+        server.on_mqtt_message(None, None, messages[i % len(messages)])
+    frames = fake_cul.wait_idle(prefix)[start:]
+    report(name, latencies, len(frames), frames[-1] - t0, coalesced=count - len(frames))
+
+
+def bench_lacrosse(server, fake_cul, count, rate):
+    """Measure RF line to published state latency and throughput"""
+    client = server.mqtt_client
+    # the sensor id has 4 bits
+    sensors = 16
+
+    def send(i):
+        sensor_id = i % sensors
+        line = lacrosse_frame(sensor_id, (i // sensors) % 500 / 10)
+        t = time.perf_counter()
+        fake_cul.send_rf(line)
+        return sensor_id, t
+
+    def topic(sensor_id):
+        return PREFIX + "/sensor/lacrosse/%d/state" % sensor_id
+
+    def published(base):
+        return sum(len(client.published[topic(s)]) for s in range(sensors)) - base
+
+    latencies = []
+    for i in range(count):
+        sensor_id, t = send(i)
+        n = len(client.published[topic(sensor_id)])
+        received = client.wait_published(topic(sensor_id), n + 1, timeout=5)
+        latencies.append(received[-1][0] - t)
+        time.sleep(1 / rate)
+
+    base = published(0)
+    t0 = time.perf_counter()
+    for i in range(count, 2 * count):
+        send(i)
+    with client.condition:
+        client.condition.wait_for(lambda: published(base) >= count, 60)
+    duration = max(t for s in range(sensors) for t, _ in client.published[topic(s)]) - t0
+    report("lacrosse", latencies, count, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--count", type=int, default=500, help="messages per path")
+    parser.add_argument("--rate", type=float, default=50, help="messages per second for latency")
+    args = parser.parse_args()
+
+    fake_cul = FakeCul()
+    with tempfile.TemporaryDirectory() as statedir:
+        server = BenchmarkServer(make_config(fake_cul.port, statedir))
+        threading.Thread(target=server.cul.listen, args=[server.on_rf_message], daemon=True).start()
+
+        somfy = []
+        for address in SOMFY_ADDRESSES:
+            msg = mqtt.MQTTMessage(topic=("%s/cover/somfy/%s/set" % (PREFIX, address)).encode())
+            msg.payload = b"CLOSE"
+            somfy.append(msg)
+        intertechno = []
+        for unit in ["0FFFF", "F0FFF", "FF0FF", "FFF0F", "FFFF0"]:
+            msg = mqtt.MQTTMessage(
+                topic=("%s/switch/intertechno/%s/set" % (PREFIX, SYSTEM_ID + unit)).encode()
+            )
+            msg.payload = b"ON"
+            intertechno.append(msg)
+
+        print("%-12s %6s %10s %10s %12s %10s" % ("path", "n", "p50 [ms]", "p99 [ms]", "max [1/s]", "coalesced"))
+        bench_command(server, fake_cul, "somfy", b"Ys", somfy, args.count, args.rate)
+        bench_command(server, fake_cul, "intertechno", b"is", intertechno, args.count, args.rate)
+        bench_lacrosse(server, fake_cul, args.count, args.rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Benchmarks for encoding Somfy and Intertechno commands
+
+Compares building frames by string formatting with the precomputed frame
+templates used for sending. Run with:
+
+    python -m pytest benchmarks/test_command_encode.py
+
+Requires pytest-benchmark.
+"""
+
+import pytest
+
+from mqtt_cul_server import cul
+from mqtt_cul_server.protocols import intertechno, somfy_shutter
+from mqtt_cul_server.testing import write_somfy_state
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.fixture(scope="module")
+def somfy(tmp_path_factory):
+    statedir = tmp_path_factory.mktemp("state")
+    write_somfy_state(statedir, "B0C004", 4125)
+    return somfy_shutter.SomfyShutter(cul.Cul("", test=True), None, "homeassistant", str(statedir))
+
+
+def test_somfy_command_string(benchmark, somfy):
+    device = somfy.devices.get("B0C004")
+    benchmark(somfy.command_string, "down", device)
+
+
+def test_somfy_encode(benchmark, somfy):
+    device = somfy.devices.get("B0C004")
+    benchmark(device.encode, somfy.COMMANDS["down"])
+
+
+def test_intertechno_command_string(benchmark):
+    benchmark(lambda: ("is" + "0F0FF0FFFF" + "FF" + "\n").encode())
+
+
+def test_intertechno_frame(benchmark):
+    unit = intertechno.Intertechno.IntertechnoUnit("0F0FF", "0FFFF")
+    benchmark(unit.frames.get, b"ON")
@@ -0,0 +1,73 @@
+"""
+Benchmarks for LaCrosse decoding
+
+Compares the string based decode_rx_data and bitwise CRC with the table
+driven fast path and the batch entry points. Run with:
+
+    python -m pytest benchmarks/test_lacrosse_decode.py
+
+Requires pytest-benchmark, the NumPy benchmark additionally requires numpy.
+"""
+
+import pytest
+
+from mqtt_cul_server import cul
+from mqtt_cul_server.protocols import lacrosse
+
+pytest.importorskip("pytest_benchmark")
+
+# frames from the tests in mqtt_cul_server/protocols/lacrosse.py
+MESSAGES = [
+    "N0199E6282EC7AAAA0000719199",
+    "N019986373FC9AAAA0000000783",
+    "N019EC615414BAAAA0000571601",
+    "N019986373FC9AAAA0000109880",
+    "N019986373EF8AAAA000002B204",
+    "N019986363E0CAAAA000001A4A0",
+    "N019ECE33398CAAAA0000A17C69",
+    "N019A86414280AAAA0000480473",
+    "N019A864143B1AAAA00000B3897",
+    "N019A864143B1AAAA000015DA99",
+    "N019A86414280AAAA0000090092",
+]
+RAW_MESSAGES = [m.encode() + b"\r\n" for m in MESSAGES]
+# roughly one day of a TX29 sending every 4 s
+CAPTURE = b"".join(RAW_MESSAGES) * 2000
+
+
+@pytest.fixture(scope="module")
+def decoder():
+    return lacrosse.LaCrosse(cul.Cul("", test=True), None, None)
+
+
+def test_decode_rx_data(benchmark, decoder):
+    benchmark(lambda: [decoder.decode_rx_data(m) for m in MESSAGES])
+
+
+def test_decode_rx_bytes(benchmark):
+    decode = lacrosse.LaCrosse.decode_rx_bytes
+    benchmark(lambda: [decode(m) for m in RAW_MESSAGES])
+
+
+def test_crc(benchmark, decoder):
+    data = bytes.fromhex(MESSAGES[0][3:11])
+    benchmark(decoder.crc, data)
+
+
+def test_crc_table(benchmark):
+    data = bytes.fromhex(MESSAGES[0][3:11])
+    benchmark(lacrosse.crc8, data)
+
+
+def test_decode_capture(benchmark, decoder):
+    lines = CAPTURE.decode().splitlines()
+    benchmark(lambda: [decoder.decode_rx_data(m) for m in lines])
+
+
+def test_decode_batch_capture(benchmark):
+    benchmark(lacrosse.LaCrosse.decode_batch, CAPTURE)
+
+
+def test_decode_batch_numpy_capture(benchmark):
+    pytest.importorskip("numpy")
+    benchmark(lacrosse.LaCrosse.decode_batch_numpy, CAPTURE)
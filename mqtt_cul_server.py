@@ -1,18 +1,36 @@
 #!/usr/bin/env python3
 
+import argparse
 import configparser
 import logging
+import signal
+import threading
 
 from mqtt_cul_server import MQTT_CUL_Server
 
 if __name__ == "__main__":
     """Control devices via MQTT and CUL RF USB stick"""
+    parser = argparse.ArgumentParser(description="Control devices via MQTT and CUL RF USB stick")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="feed a capture of received RF lines through the server instead of using the CUL")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor, 0 replays as fast as possible (default: 1)")
+    args = parser.parse_args()
+
+    config_path = "mqtt_cul_server.ini"
     config = configparser.ConfigParser()
-    config.read("mqtt_cul_server.ini")
+    config.read(config_path)
 
     if config["DEFAULT"].getboolean("verbose"):
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
 
-    mcs = MQTT_CUL_Server(config=config)
-    mcs.start()
+    mcs = MQTT_CUL_Server(config=config, replay=bool(args.replay), config_path=config_path)
+    # reload the configuration on SIGHUP, outside of the signal handler
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=mcs.reload_config).start())
+    if args.replay:
+        mcs.replay(args.replay, args.speed)
+    elif config["DEFAULT"].get("runtime", "threads") == "asyncio":
+        mcs.start_async()
+    else:
+        mcs.start()
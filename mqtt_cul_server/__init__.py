@@ -1,29 +1,237 @@
+import asyncio
+import collections
+import configparser
+import functools
+import json
 import logging
-import sys
 import threading
+import time
 import paho.mqtt.client as mqtt
-from . import cul
-from .protocols import somfy_shutter, intertechno, lacrosse
+from . import capture, cul, debug, discovery, metrics, pacing, plugins, publisher, router, spool
 
 
 class MQTT_CUL_Server:
-    components = {}
+    # seconds in which the same RF message received by several CULs is
+    # handled only once
+    RF_DEDUP_WINDOW = 0.5
+    # seconds to wait for the messages of a replayed capture to be published
+    REPLAY_PUBLISH_TIMEOUT = 30
 
-    def __init__(self, config={}):
-        self.cul = cul.Cul(config["DEFAULT"]["CUL"], int(config["DEFAULT"]["baud_rate"]))
-        self.mqtt_client = self.get_mqtt_client(config["mqtt"])
+    # sections that are only applied by a restart, besides [cul:<name>]
+    RESTART_SECTIONS = ("DEFAULT", "mqtt", "pacing", "metrics")
 
+    def __init__(self, config={}, replay=False, config_path=None):
         # prefix for all MQTT topics
         self.prefix = config["DEFAULT"]["prefix"]
+        # the config and the file it can be reloaded from, if any
+        self.config = config
+        self.config_path = config_path
+        self.reload_lock = threading.Lock()
+
+        self.statedir = config["DEFAULT"]["statedir"] or "state"
+
+        self.setup_culs(config, replay)
+        self.mqtt_client = self.get_mqtt_client(config["mqtt"])
+        # sensor readings are spooled to disk while the broker is unreachable,
+        # but not when replaying, so that replayed readings never end up in
+        # the spool the bridge publishes from
+        spool_size = int(config["mqtt"].get("spool_size", 0))
+        reading_spool = None
+        if spool_size and not replay:
+            reading_spool = spool.Spool(self.statedir + "/spool", spool_size)
+        # all messages are published through a bounded queue, so that
+        # components never block on the MQTT client
+        self.publisher = publisher.Publisher(
+            self.mqtt_client,
+            int(config["mqtt"].get("max_pending", 1000)),
+            spool=reading_spool,
+            spool_rate=int(config["mqtt"].get("spool_rate", 20)),
+        )
+
+        # discovery configs are published once connected, and only if changed
+        self.discovery = discovery.DiscoveryManager(self.publisher, self.statedir + "/discovery.json")
+
+        self.router = router.TopicRouter()
+        # Home Assistant's birth message, to publish discovery after it restarted
+        status_topic = config["DEFAULT"].get("status_topic", "homeassistant/status")
+        self.router.add(status_topic, self.discovery.on_status)
+        if config_path:
+            self.router.add(self.prefix + "/mqtt_cul_server/reload", self.on_reload_message)
+        # profiling and memory tracing on demand, idle until requested
+        self.debug = debug.DebugController(self.publisher, self.prefix + "/mqtt_cul_server/debug", self.statedir)
+        self.router.add(self.prefix + "/mqtt_cul_server/debug/set", self.debug.on_message)
+        # handlers for received RF messages by prefix, and the prefix lengths
+        self.rf_handlers = {}
+        self.rf_prefix_lengths = []
+        # recently received RF messages -> (time, CUL), oldest first
+        self.rf_recent = collections.OrderedDict()
+        self.rf_lock = threading.Lock()
+
+        # protocols are only imported if enabled in their config section
+        self.components = {}
+        for name, protocol in plugins.enabled(config):
+            self.add_component(name, protocol)
+
+        if config.has_section("metrics") and config["metrics"].getboolean("enabled"):
+            self.setup_metrics(config["metrics"])
+
+    def add_component(self, name, protocol):
+        """Create the component of a protocol and route messages to it"""
+        logging.info("Enabling protocol %s", name)
+        component = protocol.create(
+            self.cul_for(name), self.publisher, self.prefix, self.statedir, self.config[name], self.discovery
+        )
+        self.components[name] = component
+        topic_filters = component.get_topic_filters()
+        for topic_filter, handler in topic_filters.items():
+            self.router.add(topic_filter, handler)
+        for prefix, handler in component.get_rf_handlers().items():
+            self.register_rf_handler(prefix, handler)
+        if topic_filters and self.mqtt_client.is_connected():
+            self.mqtt_client.subscribe([(topic_filter, 0) for topic_filter in topic_filters])
+
+    def remove_component(self, name):
+        """
+        Stop routing messages to the component of a protocol and stop it.
+        Its discovery configs are kept.
+        """
+        logging.info("Disabling protocol %s", name)
+        component = self.components.pop(name)
+        topic_filters = list(component.get_topic_filters())
+        for topic_filter in topic_filters:
+            self.router.remove(topic_filter)
+        for prefix in component.get_rf_handlers():
+            self.rf_handlers.pop(prefix, None)
+        if topic_filters and self.mqtt_client.is_connected():
+            self.mqtt_client.unsubscribe(topic_filters)
+        # components with threads or a receive mode end them in stop()
+        if hasattr(component, "stop"):
+            component.stop()
+
+    def reload(self, config):
+        """
+        Apply a changed config without touching the CULs or the MQTT session
+
+        Protocols are enabled or disabled, and enabled ones update their
+        devices, only publishing or removing discovery configs of changed
+        devices. Changes of other sections are only applied by a restart.
+        """
+        with self.reload_lock:
+            old = self.config
+            sections = set(self.RESTART_SECTIONS)
+            sections.update(s for s in old.sections() + config.sections() if s.startswith("cul:"))
+            for section in sorted(sections):
+                if self.section_items(old, section) != self.section_items(config, section):
+                    logging.warning("Changes of [%s] are applied after a restart", section)
+
+            self.config = config
+            enabled = dict(plugins.enabled(config))
+            for name in list(self.components):
+                if name not in enabled:
+                    self.remove_component(name)
+            for name, protocol in enabled.items():
+                component = self.components.get(name)
+                if component is None:
+                    self.add_component(name, protocol)
+                elif hasattr(component, "reload"):
+                    component.reload(config[name])
+            logging.info("Reloaded configuration")
+
+    @staticmethod
+    def section_items(config, section):
+        if section == "DEFAULT":
+            return dict(config.defaults())
+        return dict(config[section]) if config.has_section(section) else None
+
+    def reload_config(self):
+        """Reload the config file, e.g. on SIGHUP"""
+        config = configparser.ConfigParser()
+        try:
+            if not config.read(self.config_path):
+                raise OSError("cannot read %s" % self.config_path)
+            self.reload(config)
+        except Exception:
+            logging.exception("Could not reload configuration")
+
+    def on_reload_message(self, _message):
+        self.reload_config()
+
+    def setup_culs(self, config, replay):
+        """
+        Open all CUL devices and route protocols and devices to them
 
-        statedir = config["DEFAULT"]["statedir"] or "state"
+        The CUL from the DEFAULT section serves all protocols that are not
+        listed in any [cul:<name>] section. When replaying a capture, the CUL
+        devices are not used.
+        """
+        pacing_config = None
+        if config.has_section("pacing") and config["pacing"].getboolean("enabled"):
+            pacing_config = config["pacing"]
+        capture_writer = None
+        if config["DEFAULT"].get("capture_file") and not replay:
+            capture_writer = capture.CaptureWriter(config["DEFAULT"]["capture_file"])
 
-        if config["intertechno"].getboolean("enabled"):
-            self.components["intertechno"] = intertechno.Intertechno(self.cul, self.mqtt_client, self.prefix, config["intertechno"])
-        if config["somfy"].getboolean("enabled"):
-            self.components["somfy"] = somfy_shutter.SomfyShutter(self.cul, self.mqtt_client, self.prefix, statedir)
-        if config["lacrosse"].getboolean("enabled"):
-            self.components["lacrosse"] = lacrosse.LaCrosse(self.cul, self.mqtt_client, self.prefix)
+        sections = [("default", config["DEFAULT"], config["DEFAULT"]["CUL"])]
+        for section in config.sections():
+            if section.startswith("cul:"):
+                sections.append((section[4:], config[section], config[section]["device"]))
+
+        self.culs = {}
+        # protocol -> CULs serving it, and protocol -> {device: CUL}
+        self.protocol_culs = collections.defaultdict(list)
+        self.device_routes = collections.defaultdict(dict)
+        for name, section, device in sections:
+            pacer = None
+            if pacing_config:
+                pacer = pacing.AirtimePacer(pacing_config)
+                pacer.on_update = functools.partial(self.publish_pacing_metrics, name=name)
+            stick = cul.Cul(device, int(section["baud_rate"]), test=replay, pacer=pacer)
+            stick.capture = capture_writer
+            self.culs[name] = stick
+
+            protocols = [p.strip() for p in section.get("protocols", "").split(",") if p.strip()]
+            devices = [d.strip() for d in section.get("devices", "").split(",") if d.strip()]
+            for protocol in protocols:
+                if devices:
+                    # this CUL only serves the listed devices of the protocol
+                    for device_name in devices:
+                        self.device_routes[protocol][device_name] = stick
+                else:
+                    self.protocol_culs[protocol].append(stick)
+        self.cul = self.culs["default"]
+
+    def cul_for(self, protocol):
+        """CUL, or group of CULs, serving a protocol"""
+        culs = self.protocol_culs.get(protocol) or [self.cul]
+        routes = self.device_routes.get(protocol)
+        if len(culs) == 1 and not routes:
+            return culs[0]
+        logging.info("%s is served by %d CULs", protocol, len(culs) + len(routes or {}))
+        return cul.CulGroup(culs, routes)
+
+    def setup_metrics(self, metrics_config):
+        """Enable metrics and expose them via HTTP and/or MQTT"""
+        metrics.enable()
+        for name, stick in self.culs.items():
+            metrics.register_gauge("cul_tx_queue_depth", stick.tx_queue.qsize, cul=name)
+            if stick.pacer:
+                metrics.register_gauge(
+                    "cul_send_credit_ms", lambda pacer=stick.pacer: pacer.metrics()["credit_ms"], cul=name
+                )
+        metrics.register_gauge("publish_queue_depth", lambda: len(self.publisher.latest), policy="latest")
+        metrics.register_gauge("publish_queue_depth", lambda: len(self.publisher.reliable), policy="reliable")
+        metrics.register_gauge("publish_dropped", lambda: self.publisher.dropped)
+        if self.publisher.spool:
+            metrics.register_gauge("spool_segments", lambda: len(self.publisher.spool.segments))
+            metrics.register_gauge("spool_dropped", lambda: self.publisher.spool.dropped)
+        http_port = int(metrics_config.get("http_port", 0))
+        if http_port:
+            metrics.start_http_server(metrics_config.get("http_host", "127.0.0.1"), http_port)
+        mqtt_interval = int(metrics_config.get("mqtt_interval", 0))
+        if mqtt_interval:
+            metrics.start_mqtt_publisher(
+                self.publisher, self.prefix + "/mqtt_cul_server/stats", mqtt_interval
+            )
 
     def get_mqtt_client(self, mqtt_config):
         mqtt_client = mqtt.Client()
@@ -34,47 +242,125 @@ class MQTT_CUL_Server:
             )
         mqtt_client.on_connect = self.on_mqtt_connect
         mqtt_client.on_message = self.on_mqtt_message
-        try:
-            mqtt_client.connect(
-                mqtt_config["host"], int(mqtt_config["port"]), keepalive=60
-            )
-        except Exception as e:
-            logging.error("Could not connect to MQTT broker: %s", e)
-            sys.exit(1)
+        # connect in the network loop, which retries until the broker is
+        # reachable, so that RF is received without broker as well
+        mqtt_client.connect_async(
+            mqtt_config["host"], int(mqtt_config["port"]), keepalive=60
+        )
         return mqtt_client
 
     def on_mqtt_connect(self, mqtt_client, _userdata, _flags, _rc):
         """The callback for when the MQTT client receives a CONNACK response"""
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        mqtt_client.subscribe(self.prefix + "/#")
+        topic_filters = self.router.filters()
+        if topic_filters:
+            mqtt_client.subscribe([(topic_filter, 0) for topic_filter in topic_filters])
+        self.discovery.on_connect()
+        self.publisher.wake()
 
     def on_mqtt_message(self, _client, _userdata, msg):
         """The callback for when a message is received"""
-        try:
-            _, _, component, _ = msg.topic.split("/", 3)
-        except ValueError:
-            logging.debug("cannot parse topic: %s", msg.topic)
+        handler, fields = self.router.route(msg.topic)
+        if handler:
+            metrics.inc("mqtt_messages_handled")
+            handler(msg, *fields)
+        else:
+            metrics.inc("mqtt_messages_unhandled")
+            logging.debug("no handler for topic %s", msg.topic)
+
+    def register_rf_handler(self, prefix, handler):
+        """Call handler for all received RF messages starting with prefix"""
+        self.rf_handlers[prefix] = handler
+        if len(prefix) not in self.rf_prefix_lengths:
+            self.rf_prefix_lengths.append(len(prefix))
+            self.rf_prefix_lengths.sort(reverse=True)
+
+    def is_duplicate(self, message, source):
+        """Check if the same RF message was just received by another CUL"""
+        now = time.monotonic()
+        with self.rf_lock:
+            recent = self.rf_recent
+            while recent:
+                oldest = next(iter(recent))
+                if now - recent[oldest][0] < self.RF_DEDUP_WINDOW:
+                    break
+                del recent[oldest]
+            seen = recent.pop(message, None)
+            recent[message] = (now, source)
+            return seen is not None and seen[1] is not source
+
+    def on_rf_message(self, message, source=None):
+        """Handle message received via RF by the CUL source"""
+        for length in self.rf_prefix_lengths:
+            handler = self.rf_handlers.get(message[0:length])
+            if handler:
+                if len(self.culs) > 1 and self.is_duplicate(message, source):
+                    metrics.inc("rf_duplicates")
+                    return
+                handler(message)
+                return
+        pacer = (source or self.cul).pacer
+        if pacer and pacer.on_rf_message(message):
             return
+        metrics.inc("rf_unknown_prefix")
+        logging.info("Can't handle RF message: %s", message)
 
-        if component in self.components:
-            self.components[component].on_message(msg)
-        else:
-            logging.debug("component %s unknown (topic %s)", component, msg.topic)
+    def publish_pacing_metrics(self, pacing_state, name="default"):
+        """Publish current send credit and pacing counters of a CUL"""
+        topic = self.prefix + "/mqtt_cul_server/pacing"
+        if name != "default":
+            topic += "/" + name
+        self.publisher.publish(topic, payload=json.dumps(pacing_state), retain=False)
 
-    def on_rf_message(self, message):
-        """Handle message received via RF"""
-        if not message: return
-        if message[0:3] == "N01":
-            self.components["lacrosse"].on_rf_message(message)
-        else:
-            logging.info("Can't handle RF message: %s", message)
+    def replay(self, path, speed=1.0):
+        """
+        Feed a capture of received RF lines through on_rf_message
+
+        The original timing is divided by speed, 0 replays as fast as possible.
+        Components with a clock see the capture time instead of the current
+        time, so that e.g. heartbeats and link quality behave as when the
+        lines were received.
+        """
+        mqtt_listener = threading.Thread(
+            target=self.mqtt_client.loop_forever, kwargs={"retry_first_connection": True}, daemon=True
+        )
+        mqtt_listener.start()
+        clock = capture.ReplayClock()
+        for component in self.components.values():
+            if hasattr(component, "clock"):
+                component.clock = clock
+        start = time.monotonic()
+        count = capture.replay(path, self.on_rf_message, speed, clock)
+        logging.info("Replayed %d lines in %.1f s", count, time.monotonic() - start)
+        # handle readings still held back by components, e.g. for diversity
+        for component in self.components.values():
+            if hasattr(component, "stop"):
+                component.stop()
+        # wait until all resulting messages have been published
+        deadline = time.monotonic() + self.REPLAY_PUBLISH_TIMEOUT
+        while self.publisher.latest or self.publisher.reliable:
+            if time.monotonic() > deadline:
+                logging.warning("Timed out publishing the replayed messages, discarding the rest")
+                break
+            time.sleep(0.1)
+        self.mqtt_client.disconnect()
 
     def start(self):
         """Start multiple threads to listen for MQTT and RF messages"""
         # thread to listen for MQTT command messages
-        mqtt_listener = threading.Thread(target=self.mqtt_client.loop_forever)
+        mqtt_listener = threading.Thread(
+            target=self.mqtt_client.loop_forever, kwargs={"retry_first_connection": True}
+        )
         mqtt_listener.start()
-        # thread to listen for received RF messages
-        cul_listener = threading.Thread(target=self.cul.listen, args=[self.on_rf_message])
-        cul_listener.start()
+        # threads to listen for received RF messages, one per CUL
+        for stick in self.culs.values():
+            callback = functools.partial(self.on_rf_message, source=stick)
+            cul_listener = threading.Thread(target=stick.listen, args=[callback])
+            cul_listener.start()
+
+    def start_async(self):
+        """Run on one asyncio event loop instead of listener threads"""
+        from . import aio
+
+        asyncio.run(aio.AsyncRuntime(self).run())
@@ -0,0 +1,295 @@
+"""
+Optional asyncio runtime
+
+Instead of a thread running the MQTT network loop and a blocking reader
+thread per CUL, one event loop watches the MQTT socket and the serial
+devices, and handles received messages. The CUL writer and the publisher
+keep their threads, as they are fed through queues. Blocking calls, like
+reconnecting to the broker, run in the loop's executor. SIGINT and SIGTERM shut down all tasks, the MQTT connection and
+the serial devices in one place.
+"""
+
+import asyncio
+import functools
+import logging
+import signal
+
+import paho.mqtt.client as mqtt
+import serial
+
+from . import metrics
+from .cul import Cul
+
+
+class AsyncRuntime:
+    """Run an MQTT_CUL_Server on a single asyncio event loop"""
+
+    # seconds between calls of the MQTT client's housekeeping
+    MQTT_MISC_INTERVAL = 1
+    # seconds to wait before reconnecting to the broker, doubled on failure
+    MQTT_RETRY = 1
+    MQTT_RETRY_MAX = 60
+    # seconds to wait for pending messages to be published on shutdown
+    SHUTDOWN_TIMEOUT = 2
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self.stopped = None
+        self.tasks = set()
+
+    def spawn(self, coroutine):
+        """Run a coroutine as task, which is cancelled on shutdown"""
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error("Error in task", exc_info=task.exception())
+
+    def stop(self):
+        self.stopped.set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.stop)
+
+        self.attach_mqtt(self.server.mqtt_client)
+        for stick in self.server.culs.values():
+            self.attach_cul(stick)
+        try:
+            await self.stopped.wait()
+        finally:
+            await self.shutdown()
+
+    def attach_mqtt(self, client):
+        """Drive the paho client from the loop, via its socket callbacks"""
+        def threadsafe(method):
+            # the publisher thread triggers these callbacks, too
+            def callback(_client, _userdata, sock):
+                try:
+                    in_loop = asyncio.get_running_loop() is self.loop
+                except RuntimeError:
+                    in_loop = False
+                if in_loop:
+                    method(sock)
+                else:
+                    self.loop.call_soon_threadsafe(method, sock)
+            return callback
+
+        def add_reader(sock):
+            self.loop.add_reader(sock, client.loop_read)
+
+        def add_writer(sock):
+            self.loop.add_writer(sock, client.loop_write)
+
+        client.on_socket_open = threadsafe(add_reader)
+        client.on_socket_close = threadsafe(self.loop.remove_reader)
+        client.on_socket_register_write = threadsafe(add_writer)
+        client.on_socket_unregister_write = threadsafe(self.loop.remove_writer)
+        # the client connected before the callbacks were set
+        sock = client.socket()
+        if sock:
+            add_reader(sock)
+            if client.want_write():
+                add_writer(sock)
+        self.spawn(self.mqtt_misc(client))
+
+    async def mqtt_misc(self, client):
+        """Send keepalives and reconnect to the broker when disconnected"""
+        retry = self.MQTT_RETRY
+        while True:
+            await asyncio.sleep(self.MQTT_MISC_INTERVAL)
+            if client.loop_misc() != mqtt.MQTT_ERR_NO_CONN:
+                continue
+            try:
+                # resolves the host name and connects, without blocking the loop
+                await self.loop.run_in_executor(None, client.reconnect)
+                retry = self.MQTT_RETRY
+            except OSError as e:
+                logging.warning("Could not reconnect to MQTT broker: %s", e)
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, self.MQTT_RETRY_MAX)
+
+    def attach_cul(self, stick):
+        """Read received lines of a CUL whenever its device is readable"""
+        callback = functools.partial(self.server.on_rf_message, source=stick)
+        if stick.capture:
+            callback = stick.capture.tee(callback)
+        if stick.connected.is_set():
+            self.watch_cul(stick, callback)
+        else:
+            self.spawn(self.reopen_cul(stick, callback))
+
+    def watch_cul(self, stick, callback):
+        buffer = bytearray()
+        fd = stick.serial.fileno()
+
+        def on_disconnected():
+            self.loop.remove_reader(fd)
+            self.spawn(self.reopen_cul(stick, callback))
+
+        def notify():
+            # read and write errors both close the device, the latter in the
+            # writer thread
+            try:
+                self.loop.call_soon_threadsafe(on_disconnected)
+            except RuntimeError:
+                # the loop was closed on shutdown
+                pass
+
+        stick.on_disconnect = notify
+
+        def on_readable():
+            try:
+                data = stick.serial.read(stick.serial.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                logging.error("Could not read from CUL device: %s", e)
+                stick.disconnect()
+                return
+            buffer.extend(data)
+            Cul.split_lines(buffer, callback)
+            if len(buffer) > stick.MAX_LINE:
+                logging.info("Discarding %d bytes without line break", len(buffer))
+                buffer.clear()
+
+        self.loop.add_reader(fd, on_readable)
+
+    async def reopen_cul(self, stick, callback):
+        """Reopen a CUL device with exponential backoff"""
+        retry = stick.READ_RETRY
+        while not stick.open():
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, stick.READ_RETRY_MAX)
+        metrics.inc("serial_reconnects")
+        self.watch_cul(stick, callback)
+
+    async def shutdown(self):
+        """Cancel all tasks, then close the MQTT connection and the CULs"""
+        logging.info("Shutting down")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.remove_signal_handler(signum)
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        publisher = getattr(self.server, "publisher", None)
+        deadline = self.loop.time() + self.SHUTDOWN_TIMEOUT
+        while publisher and (publisher.latest or publisher.reliable) and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        client = self.server.mqtt_client
+        client.disconnect()
+        client.loop_write()
+
+        for stick in self.server.culs.values():
+            stick.on_disconnect = None
+            if stick.connected.is_set() and not stick.test:
+                self.loop.remove_reader(stick.serial.fileno())
+                stick.serial.close()
+
+
+def test_async_runtime():
+    import os
+
+    class Client:
+        def socket(self):
+            return None
+
+        def loop_misc(self):
+            return mqtt.MQTT_ERR_SUCCESS
+
+        def disconnect(self):
+            pass
+
+        def loop_write(self):
+            pass
+
+    class Server:
+        def __init__(self, stick):
+            self.culs = {"default": stick}
+            self.mqtt_client = Client()
+            self.received = []
+
+        def on_rf_message(self, message, source=None):
+            self.received.append(message)
+            if len(self.received) == 3:
+                runtime.stop()
+
+    master, slave = os.openpty()
+    stick = Cul(os.ttyname(slave))
+    server = Server(stick)
+    runtime = AsyncRuntime(server)
+
+    async def main():
+        task = asyncio.ensure_future(runtime.run())
+        await asyncio.sleep(0.05)
+        os.write(master, b"N0199E6282EC7AAAA0000719199\r\nN0199")
+        await asyncio.sleep(0.05)
+        os.write(master, b"86373FC9AAAA0000000783\r\n")
+        await asyncio.sleep(0.05)
+        # a write error in the writer thread closes the device, which is reopened
+        await asyncio.to_thread(stick.disconnect)
+        await asyncio.sleep(0.2)
+        assert stick.connected.is_set()
+        os.write(master, b"N019ECE33398CAAAA0000A17C69\r\n")
+        await asyncio.wait_for(task, 2)
+
+    asyncio.run(main())
+    assert server.received == [
+        b"N0199E6282EC7AAAA0000719199", b"N019986373FC9AAAA0000000783", b"N019ECE33398CAAAA0000A17C69"
+    ]
+
+
+def test_mqtt_reconnect():
+    import threading
+    import time
+
+    class Client:
+        def __init__(self):
+            self.connected = False
+            self.reconnect_thread = None
+
+        def socket(self):
+            return None
+
+        def loop_misc(self):
+            return mqtt.MQTT_ERR_SUCCESS if self.connected else mqtt.MQTT_ERR_NO_CONN
+
+        def reconnect(self):
+            self.reconnect_thread = threading.current_thread()
+            time.sleep(0.2)
+            self.connected = True
+
+        def disconnect(self):
+            pass
+
+        def loop_write(self):
+            pass
+
+    class Server:
+        culs = {}
+        mqtt_client = Client()
+
+    class QuickRuntime(AsyncRuntime):
+        MQTT_MISC_INTERVAL = 0.01
+
+    runtime = QuickRuntime(Server())
+
+    async def main():
+        task = asyncio.ensure_future(runtime.run())
+        # the loop keeps running while the client reconnects
+        ticks = 0
+        while not Server.mqtt_client.connected:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        runtime.stop()
+        await asyncio.wait_for(task, 2)
+        return ticks
+
+    assert asyncio.run(main()) > 5
+    assert Server.mqtt_client.reconnect_thread is not threading.main_thread()
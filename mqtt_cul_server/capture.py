@@ -0,0 +1,119 @@
+"""
+Capture received RF lines to a file and replay them
+
+A capture file starts with a magic header, followed by one record per line:
+the monotonic receive time in ns and the line length as little-endian
+uint64 / uint16, then the line itself without line ending. Records are only
+ever appended. Captures are read through mmap, so that even very large files
+are streamed instead of being loaded into memory.
+"""
+
+import logging
+import mmap
+import struct
+import threading
+import time
+
+MAGIC = b"CULCAP1\n"
+RECORD = struct.Struct("<QH")
+
+
+class CaptureWriter:
+    """Append received lines with their receive time to a capture file"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        logging.info("Capturing received RF lines to %s", path)
+
+    def write(self, line, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        with self.lock:
+            self.file.write(RECORD.pack(timestamp, len(line)))
+            self.file.write(line)
+            self.file.flush()
+
+    def tee(self, callback):
+        """Wrap callback, so that each line is captured before handling it"""
+        def capture_and_call(line):
+            self.write(line)
+            callback(line)
+        return capture_and_call
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def iter_capture(path):
+    """Yield (timestamp in ns, line) for each record of a capture file"""
+    with open(path, "rb") as file_handle:
+        with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[0:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a capture file" % path)
+            offset = len(MAGIC)
+            end = len(data)
+            while offset + RECORD.size <= end:
+                timestamp, length = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                if offset + length > end:
+                    logging.warning("Truncated record at end of %s", path)
+                    break
+                yield timestamp, data[offset:offset + length]
+                offset += length
+
+
+class ReplayClock:
+    """Time source returning the capture time in seconds of the replayed line"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def replay(path, callback, speed=1.0, clock=None):
+    """
+    Feed a capture to callback, keeping the original timing divided by speed
+
+    A speed of 0 replays as fast as possible. If given, the ReplayClock clock
+    is set to the capture time of each line before calling callback. Returns
+    the number of lines.
+    """
+    count = 0
+    start = None
+    for timestamp, line in iter_capture(path):
+        if clock is not None:
+            clock.now = timestamp / 1e9
+        if speed:
+            if start is None:
+                start = (timestamp, time.monotonic_ns())
+            delay = (timestamp - start[0]) / speed - (time.monotonic_ns() - start[1])
+            if delay > 0:
+                time.sleep(delay / 1e9)
+        callback(line)
+        count += 1
+    return count
+
+
+def test_capture(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    writer = CaptureWriter(path)
+    lines = [b"N0199E6282EC7AAAA0000719199", b"", b"N019986373FC9AAAA0000000783"]
+    tee = writer.tee(lambda line: None)
+    for i, line in enumerate(lines):
+        writer.write(line, timestamp=i * 1000)
+    tee(b"21  900")
+    writer.close()
+    records = list(iter_capture(path))
+    assert [line for _, line in records] == lines + [b"21  900"]
+    assert [timestamp for timestamp, _ in records[:3]] == [0, 1000, 2000]
+    replayed = []
+    clock = ReplayClock()
+    assert replay(path, lambda line: replayed.append((line, clock())), speed=0, clock=clock) == 4
+    assert replayed[0:3] == [(line, i * 1e-6) for i, line in enumerate(lines)]
+    assert replayed[3][0] == b"21  900"
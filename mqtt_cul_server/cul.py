@@ -1,27 +1,125 @@
 import sys
+import functools
 import logging
 import os
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import serial
+from . import metrics
+
+# transmit priorities, lower values are sent first
+PRIORITY_CONTROL = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
 
 
 class Cul(object):
     """Helper class to encapsulate serial communication with CUL device"""
 
-    def __init__(self, serial_port, baud_rate=115200, test=False):
-        """Create instance with a given serial port"""
+    # maximum number of queued commands coalesced into one serial write
+    MAX_BURST = 8
+    # seconds the writer thread waits for commands before doing housekeeping
+    IDLE_TIMEOUT = 1
+    # seconds to wait before reopening the device, doubled on each failure
+    READ_RETRY = 0.1
+    READ_RETRY_MAX = 10
+    # commands buffered while the device is disconnected, and the seconds a
+    # command may wait for the device to reconnect before it is dropped
+    # instead of sent late. Waiting for send credit while connected does not
+    # count.
+    MAX_BUFFERED = 100
+    COMMAND_TTL = 30
+    # discard received data exceeding this length without a line break
+    MAX_LINE = 1024
+
+    def __init__(self, serial_port, baud_rate=115200, test=False, pacer=None):
+        """
+        Create instance with a given serial port
+
+        If the device cannot be opened, e.g. because it is not plugged in,
+        listen() keeps trying to open it. Commands are buffered meanwhile.
+        """
+        self.serial_port = serial_port
+        self.baud_rate = baud_rate
+        self.serial = None
+        # set while the device is open
+        self.connected = threading.Event()
+        self.connection_lock = threading.Lock()
+        # when the device was last disconnected, or not yet opened
+        self.disconnected_at = time.monotonic()
+        # optional function called after the device was closed on an error,
+        # from the thread that hit the error
+        self.on_disconnect = None
+
+        # command to return to receive mode after transmitting, if any. It is
+        # also what protocols set up on the CUL, restored after each reconnect.
+        self.receive_mode = None
+
+        # optional AirtimePacer to respect the duty cycle limit
+        self.pacer = pacer
+
+        # optional CaptureWriter to record all received lines
+        self.capture = None
+
+        # commands are written by a dedicated thread, so that callers (e.g.
+        # the MQTT network loop) never block on serial I/O
+        self.tx_queue = queue.PriorityQueue()
+        self.tx_sequence = itertools.count()
+        # key -> [command, Future] of queued commands that can be replaced
+        self.coalesced = {}
+        self.coalesce_lock = threading.Lock()
+
         if test:
             self.serial = sys.stderr
             self.test = True
+            self.connected.set()
         else:
             self.test = False
-            if not os.path.exists(serial_port):
-                raise ValueError("cannot find CUL device %s" % serial_port)
+            self.open()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def open(self):
+        """
+        Open the serial device, restoring the receive mode. Returns whether
+        the device is open.
+        """
+        if not os.path.exists(self.serial_port):
+            logging.error("cannot find CUL device %s", self.serial_port)
+            return False
+        try:
+            self.serial = serial.Serial(
+                port=self.serial_port, baudrate=self.baud_rate, timeout=1
+            )
+        except (serial.SerialException, OSError) as e:
+            logging.error("Could not open CUL device: %s", e)
+            return False
+        # queued before any buffered command, as it has the top priority
+        if self.receive_mode:
+            self.send_command(self.receive_mode, priority=PRIORITY_CONTROL)
+        logging.info("Opened CUL device %s", self.serial_port)
+        self.connected.set()
+        return True
+
+    def disconnect(self):
+        """Close the device after an I/O error, listen() will reopen it"""
+        with self.connection_lock:
+            if not self.connected.is_set():
+                return
+            self.connected.clear()
+            self.disconnected_at = time.monotonic()
+            logging.warning("Lost connection to CUL device %s", self.serial_port)
+            metrics.inc("serial_disconnects")
             try:
-                self.serial = serial.Serial(
-                    port=serial_port, baudrate=baud_rate, timeout=1
-                )
-            except serial.SerialException as e:
-                logging.error("Could not open CUL device: %s", e)
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                pass
+        if self.on_disconnect:
+            self.on_disconnect()
 
     def get_cul_version(self):
         """Get CUL version"""
@@ -30,30 +128,377 @@ class Cul(object):
         version = self.serial.readline()
         return version
 
-    def send_command(self, command_string):
-        """Send command string to serial port with CUL device"""
-        if self.test:
-            print(command_string.decode())
+    def route(self, _device):
+        """CUL device to send commands for a device to"""
+        return self
+
+    def set_receive_mode(self, command_string):
+        """
+        Enter receive mode and set it as the mode to return to after each
+        transmit burst. None only stops returning to a receive mode.
+        """
+        self.receive_mode = command_string
+        if command_string is None:
+            future = Future()
+            future.set_result(0)
+            return future
+        return self.send_command(command_string, priority=PRIORITY_CONTROL)
+
+    def send_command(self, command_string, callback=None, priority=PRIORITY_NORMAL, key=None, prefix=b""):
+        """
+        Queue command string for sending to the CUL device
+
+        Returns a Future that is resolved once the command has been flushed to
+        the serial port. If given, callback is called with that Future.
+        Commands with a lower priority value are sent first.
+
+        command_string may also be a callable returning the command, which is
+        called right before sending, e.g. to use the current rolling code.
+        Its air time is estimated from prefix, e.g. b"Ys", as it is not built
+        while it waits for send credit. If key is given, a command with the
+        same key that has not been sent yet is replaced, keeping its place in
+        the queue and its Future.
+        """
+        if key is not None:
+            with self.coalesce_lock:
+                pending = self.coalesced.get(key)
+                if pending is not None:
+                    pending[0] = command_string
+                    metrics.inc("commands_coalesced")
+                    if callback:
+                        pending[1].add_done_callback(callback)
+                    return pending[1]
+                future = Future()
+                if self.is_buffer_full(priority):
+                    return self.reject(future, callback)
+                self.coalesced[key] = [command_string, future]
+            command_string = functools.partial(self.take_coalesced, key)
         else:
+            future = Future()
+            if self.is_buffer_full(priority):
+                return self.reject(future, callback)
+        if callback:
+            future.add_done_callback(callback)
+        # the last field is what the air time is estimated from
+        frame = prefix if callable(command_string) else command_string
+        self.tx_queue.put((priority, next(self.tx_sequence), command_string, future, time.monotonic(), frame))
+        return future
+
+    def is_buffer_full(self, priority):
+        """Check if no more commands can be buffered while disconnected"""
+        return priority != PRIORITY_CONTROL and not self.connected.is_set() \
+            and self.tx_queue.qsize() >= self.MAX_BUFFERED
+
+    def reject(self, future, callback):
+        logging.warning("CUL device disconnected and buffer full, dropping command")
+        metrics.inc("commands_dropped", reason="buffer_full")
+        if callback:
+            future.add_done_callback(callback)
+        future.set_exception(queue.Full("CUL device disconnected"))
+        return future
+
+    def discard(self, item, reason):
+        """Resolve a queued item that will not be sent"""
+        if isinstance(item[2], functools.partial) and item[2].func == self.take_coalesced:
+            # a replaceable command, which must no longer be replaced
+            item[2]()
+        metrics.inc("commands_dropped", reason=reason)
+        item[3].set_exception(TimeoutError("command expired before it could be sent"))
+
+    def is_expired(self, item, now):
+        """Check if a command waited for a reconnect longer than COMMAND_TTL"""
+        return item[0] != PRIORITY_CONTROL and now - max(item[4], self.disconnected_at) > self.COMMAND_TTL
+
+    def expire_commands(self):
+        """Drop commands buffered while disconnected for longer than COMMAND_TTL"""
+        items = []
+        while True:
+            try:
+                items.append(self.tx_queue.get_nowait())
+            except queue.Empty:
+                break
+        now = time.monotonic()
+        for item in items:
+            if self.is_expired(item, now):
+                logging.warning("Dropping command buffered for %.0f s", now - max(item[4], self.disconnected_at))
+                self.discard(item, "expired")
+            else:
+                self.tx_queue.put(item)
+
+    def take_coalesced(self, key):
+        """Latest command queued with key, which can no longer be replaced"""
+        with self.coalesce_lock:
+            command_string, _ = self.coalesced.pop(key)
+        return command_string
+
+    def next_command(self, block):
+        """Take the next queued item, the command may still have to be built"""
+        if block:
+            return self.tx_queue.get(timeout=self.IDLE_TIMEOUT)
+        return self.tx_queue.get_nowait()
+
+    @staticmethod
+    def build(item):
+        """Item with the command built if callable, once it is about to be written"""
+        command_string = item[2]
+        while callable(command_string):
+            command_string = command_string()
+        if command_string is item[2]:
+            return item
+        return (item[0], item[1], command_string, item[3], item[4], command_string)
+
+    def write_loop(self):
+        """Drain TX queue, coalescing back-to-back commands into one write"""
+        held = None
+        while True:
+            if not self.connected.wait(self.IDLE_TIMEOUT):
+                # buffer commands until listen() reopened the device
+                self.expire_commands()
+                continue
+            if self.pacer and self.pacer.poll_due():
+                self.send_command(b"X\n", priority=PRIORITY_CONTROL)
             try:
-                self.serial.write(command_string)
+                item = self.next_command(block=True)
+            except queue.Empty:
+                continue
+
+            burst = []
+            airtime = 0
+            while True:
+                frame_airtime = self.pacer.airtime(item[5]) if self.pacer else 0
+                delay = self.pacer.delay(airtime + frame_airtime) if self.pacer else 0
+                if delay:
+                    # out of send credit: put the frame back unbuilt, so that a
+                    # more urgent command arriving meanwhile can overtake it,
+                    # and a newer command with the same key can replace it
+                    self.tx_queue.put(item)
+                    break
+                burst.append(self.build(item))
+                airtime += frame_airtime
+                if len(burst) >= self.MAX_BURST:
+                    break
+                try:
+                    item = self.next_command(block=False)
+                except queue.Empty:
+                    break
 
-                # FIXME: this is lacrosse-specific and should not be in this class
-                self.serial.write(b"Nr1\n")
+            if burst:
+                self.write_burst(burst)
+            else:
+                if held != item[1]:
+                    held = item[1]
+                    self.pacer.mark_delayed()
+                    logging.info("Send credit exhausted, delaying command by %.1f s", delay)
+                time.sleep(min(delay, self.IDLE_TIMEOUT))
 
+    def write_burst(self, burst):
+        """Write a list of queued (priority, seq, command, future, time, frame) items"""
+        if self.pacer:
+            for item in burst:
+                self.pacer.consume(self.pacer.airtime(item[2]))
+        data = b"".join(item[2] for item in burst)
+        # return to receive mode once per burst instead of after each frame
+        if self.receive_mode and not data.endswith(self.receive_mode):
+            data += self.receive_mode
+
+        start = time.monotonic()
+        if self.test:
+            print(data.decode(), end="")
+        else:
+            try:
+                self.serial.write(data)
                 self.serial.flush()
-            except serial.SerialException as e:
+            except (serial.SerialException, OSError) as e:
                 logging.error("Could not send command to CUL device %s", e)
-                sys.exit(1)
-
+                metrics.inc("serial_write_errors")
+                # keep the commands, to send them after reconnecting
+                for item in burst:
+                    self.tx_queue.put(item)
+                self.disconnect()
+                return
+        flushed = time.monotonic()
+        if metrics.enabled:
+            metrics.observe("serial_write_seconds", flushed - start)
+            metrics.inc("serial_writes")
+            metrics.inc("serial_frames_written", len(burst))
+            for item in burst:
+                if item[0] != PRIORITY_CONTROL:
+                    metrics.observe("command_latency_seconds", flushed - item[4])
+        for item in burst:
+            item[3].set_result(len(data))
 
     def listen(self, callback):
+        """
+        Read lines from the CUL device and call callback with each line
+
+        Lines are passed as bytes without line ending, empty lines are
+        skipped. After a read error, e.g. when the device was unplugged, it
+        is reopened with exponential backoff.
+        """
+        if self.capture:
+            callback = self.capture.tee(callback)
+        buffer = bytearray()
+        retry = self.READ_RETRY
         while True:
-            # readline() blocks until message is available
+            if not self.connected.is_set():
+                if not self.open():
+                    time.sleep(retry)
+                    retry = min(retry * 2, self.READ_RETRY_MAX)
+                    continue
+                metrics.inc("serial_reconnects")
+                retry = self.READ_RETRY
+                buffer.clear()
             try:
-                message = self.serial.readline().decode("utf-8")
-                if message:
-                    logging.debug("Received RF message: %s", message)
-                callback(message)
-            except:
-                pass
+                # block for up to the timeout until data is available, then
+                # take everything that has been received in one read
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                logging.error("Could not read from CUL device: %s", e)
+                self.disconnect()
+                continue
+            if not data:
+                continue
+
+            buffer += data
+            self.split_lines(buffer, callback)
+            if len(buffer) > self.MAX_LINE:
+                logging.info("Discarding %d bytes without line break", len(buffer))
+                buffer.clear()
+
+    @staticmethod
+    def split_lines(buffer, callback):
+        """Call callback for each complete line in buffer and remove them"""
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if not line:
+                continue
+            logging.debug("Received RF message: %s", line)
+            metrics.inc("rf_lines_received")
+            try:
+                callback(line)
+            except Exception:
+                logging.exception("Error handling RF message %s", line)
+        del buffer[:start]
+
+class CulGroup:
+    """
+    Several CUL devices serving the same protocol
+
+    Commands are sent via the first CUL, unless a device is routed to another
+    one. The receive mode is set on all of them.
+    """
+
+    def __init__(self, culs, routes=None):
+        self.culs = culs
+        self.routes = routes or {}
+
+    def route(self, device):
+        """CUL device to send commands for a device to"""
+        return self.routes.get(device, self.culs[0])
+
+    def set_receive_mode(self, command_string):
+        futures = [cul.set_receive_mode(command_string) for cul in self.culs]
+        return futures[0]
+
+    def send_command(self, command_string, callback=None, priority=PRIORITY_NORMAL, key=None, prefix=b""):
+        return self.culs[0].send_command(command_string, callback, priority, key, prefix)
+
+
+def test_send_command():
+    cul_device = Cul("", test=True)
+    done = []
+    cul_device.set_receive_mode(b"Nr1\n")
+    futures = [
+        cul_device.send_command(b"isFFFF0FFFFFFF\n", callback=done.append),
+        cul_device.send_command(b"isFFFF0FFFFFF0\n", callback=done.append),
+    ]
+    for future in futures:
+        assert future.result(timeout=1) > 0
+    assert done == futures
+
+
+def test_coalesce():
+    from .testing import HeldWriter
+
+    cul_device = Cul("", test=True)
+    writer = HeldWriter(cul_device)
+    first = cul_device.send_command(b"A\n", key="a")
+    cul_device.send_command(b"B\n", key="b")
+    second = cul_device.send_command(lambda: b"C\n", key="a")
+    assert first is second
+    assert writer.release(2) == [b"C\n", b"B\n"]
+
+
+def test_coalesce_paced():
+    from .pacing import AirtimePacer
+    from .testing import HeldWriter
+
+    class QuickCul(Cul):
+        IDLE_TIMEOUT = 0.01
+
+    pacer = AirtimePacer()
+    pacer.last_poll = time.monotonic()
+    cul_device = QuickCul("", test=True, pacer=pacer)
+    writer = HeldWriter(cul_device)
+    writer.release(0)
+    built = []
+
+    def build(command_string):
+        built.append(command_string)
+        return command_string
+
+    # out of send credit, the first command is held back unbuilt ...
+    pacer.credit_ms = 0
+    first = cul_device.send_command(lambda: build(b"YsA1210010B0C004\n"), key="a", prefix=b"Ys")
+    deadline = time.monotonic() + 1
+    while not pacer.frames_delayed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # ... so that it can still be replaced
+    second = cul_device.send_command(lambda: build(b"YsA2450011B0C004\n"), key="a", prefix=b"Ys")
+    assert first is second
+    time.sleep(0.05)
+    assert built == [] and pacer.frames_delayed == 1
+    pacer.credit_ms = pacer.max_credit_ms
+    assert writer.release(1) == [b"YsA2450011B0C004\n"]
+    assert built == [b"YsA2450011B0C004\n"]
+
+
+def test_buffering():
+    class QuickCul(Cul):
+        IDLE_TIMEOUT = 0.01
+
+    cul_device = QuickCul("", test=True)
+    cul_device.connected.clear()
+    # let the writer notice the disconnect
+    time.sleep(0.05)
+    cul_device.MAX_BUFFERED = 2
+    cul_device.COMMAND_TTL = 0
+    futures = [cul_device.send_command(b"isFFFF0FFFFFFF\n") for _ in range(2)]
+    futures.append(cul_device.send_command(b"isFFFF0FFFFFF0\n", key="a"))
+    assert isinstance(futures[2].exception(timeout=0), queue.Full)
+    time.sleep(0.01)
+    cul_device.expire_commands()
+    for future in futures[0:2]:
+        assert isinstance(future.exception(timeout=0), TimeoutError)
+    # a replaceable command is queued again, once the old one expired
+    cul_device.COMMAND_TTL = 30
+    cul_device.connected.set()
+    assert cul_device.send_command(b"isFFFF0FFFFFF0\n", key="a").result(timeout=1) > 0
+    # commands held back while connected, e.g. for send credit, don't expire
+    future = Future()
+    queued = time.monotonic() - 60
+    cul_device.tx_queue.put((PRIORITY_NORMAL, next(cul_device.tx_sequence), b"X\n", future, queued, b"X\n"))
+    assert future.result(timeout=1) > 0
+
+
+def test_split_lines():
+    lines = []
+    buffer = bytearray(b"N0199E6282EC7AAAA0000719199\r\n\r\nN0199")
+    Cul.split_lines(buffer, lines.append)
+    assert lines == [b"N0199E6282EC7AAAA0000719199"]
+    assert buffer == b"N0199"
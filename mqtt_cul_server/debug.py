@@ -0,0 +1,190 @@
+"""
+On-demand profiling and memory tracing
+
+Controlled via MQTT, so that hot paths can be diagnosed without restarting.
+Commands sent to <prefix>/mqtt_cul_server/debug/set are
+
+- "profile [seconds]": sample the stacks of all threads every few ms
+- "memory [seconds]": trace memory allocations with tracemalloc
+- "stop": end a running session early
+
+Results are dumped to <statedir>/debug/ and a summary of the top entries is
+published to <prefix>/mqtt_cul_server/debug. Nothing runs between sessions.
+"""
+
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class DebugController:
+    """Run one profiling or memory tracing session at a time"""
+
+    DEFAULT_SECONDS = 30
+    MAX_SECONDS = 600
+    # seconds between two stack samples
+    SAMPLE_INTERVAL = 0.005
+    # number of entries in the published summary
+    TOP = 15
+
+    def __init__(self, publisher, topic, statedir):
+        self.publisher = publisher
+        self.topic = topic
+        self.directory = statedir + "/debug"
+        self.lock = threading.Lock()
+        self.session = None
+        self.stop_event = threading.Event()
+
+    def on_message(self, message):
+        """Handle a command sent to the debug topic"""
+        words = message.payload.decode(errors="replace").split()
+        if not words:
+            return
+        if words[0] == "stop":
+            self.stop_event.set()
+            return
+        sessions = {"profile": self.profile, "memory": self.trace_memory}
+        if words[0] not in sessions:
+            logging.warning("Unknown debug command %s", words[0])
+            return
+        try:
+            seconds = min(float(words[1]), self.MAX_SECONDS) if len(words) > 1 else self.DEFAULT_SECONDS
+        except ValueError:
+            logging.warning("Invalid duration %s", words[1])
+            return
+        with self.lock:
+            if self.session is not None:
+                logging.warning("Debug session %s already running", self.session)
+                return
+            self.session = words[0]
+            self.stop_event.clear()
+        threading.Thread(target=self.run, args=[sessions[words[0]], seconds], daemon=True).start()
+
+    def run(self, session, seconds):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            summary = session(seconds)
+            self.publisher.publish(self.topic, payload=json.dumps(summary), retain=False)
+        except Exception:
+            logging.exception("Debug session failed")
+        finally:
+            with self.lock:
+                self.session = None
+
+    def dump_path(self, kind, extension):
+        return "%s/%s-%s.%s" % (self.directory, kind, time.strftime("%Y%m%d-%H%M%S"), extension)
+
+    def sample(self, seconds):
+        """Sample stacks of all other threads, returns (samples, stack counts)"""
+        me = threading.get_ident()
+        names = {}
+        stacks = collections.Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self.stop_event.wait(self.SAMPLE_INTERVAL):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    thread = threading._active.get(ident)
+                    names[ident] = thread.name if thread else str(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names[ident])
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+        return samples, stacks
+
+    def profile(self, seconds):
+        """Sampling profile of all threads, dumped as collapsed stacks"""
+        logging.info("Profiling for %.0f s", seconds)
+        samples, stacks = self.sample(seconds)
+        path = self.dump_path("profile", "txt")
+        # one line per stack as used by flamegraph tools
+        with open(path, "w", encoding="utf8") as file_handle:
+            for stack, count in stacks.most_common():
+                file_handle.write("%s %d\n" % (";".join(stack), count))
+
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack[1:]):
+                total[function] += count
+        return {
+            "session": "profile",
+            "samples": samples,
+            "file": path,
+            # share of samples in which a function was running / on the stack
+            "own": [[f, round(c / samples, 3)] for f, c in own.most_common(self.TOP)] if samples else [],
+            "total": [[f, round(c / samples, 3)] for f, c in total.most_common(self.TOP)] if samples else [],
+        }
+
+    def trace_memory(self, seconds):
+        """Allocations that grew during the session, by line"""
+        logging.info("Tracing memory for %.0f s", seconds)
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            self.stop_event.wait(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+        path = self.dump_path("memory", "tracemalloc")
+        after.dump(path)
+        return {
+            "session": "memory",
+            "file": path,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                [str(diff.traceback), diff.size_diff, diff.count_diff]
+                for diff in after.compare_to(before, "lineno")[0:self.TOP]
+            ],
+        }
+
+
+def test_debug_controller(tmp_path):
+    from .testing import Message, RecordingPublisher
+
+    def busy(stop):
+        while not stop.is_set():
+            sum(range(100))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=busy, args=[stop], name="busy")
+    worker.start()
+    publisher = RecordingPublisher()
+    controller = DebugController(publisher, "debug", str(tmp_path))
+    try:
+        controller.on_message(Message(b"profile 0.2"))
+        controller.on_message(Message(b"memory 0.1"))
+        deadline = time.monotonic() + 2
+        while controller.session and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        worker.join()
+    summary = publisher.payloads()[0]
+    assert summary["session"] == "profile" and summary["samples"] > 0
+    assert any(function.startswith("busy") for function, _ in summary["total"])
+    assert os.path.exists(summary["file"])
+    # only one session at a time
+    assert len(publisher.published) == 1
+    controller.on_message(Message(b"memory 0.1"))
+    deadline = time.monotonic() + 2
+    while controller.session and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert publisher.payloads()[1]["session"] == "memory"
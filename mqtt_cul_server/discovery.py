@@ -0,0 +1,142 @@
+"""
+Home Assistant MQTT discovery
+
+Components announce their discovery configs to a DiscoveryManager instead of
+publishing them directly. Configs are published in one batch once the MQTT
+client is connected. A hash of each published config is kept in a state
+file, so that unchanged retained configs are not published again on every
+restart. All configs are published again when Home Assistant announces that
+it (re)started via its birth message.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# payload of the Home Assistant birth message
+STATUS_ONLINE = b"online"
+
+
+class DiscoveryManager:
+    """Publish discovery configs after connecting, skipping unchanged ones"""
+
+    def __init__(self, publisher, statefile=None):
+        self.publisher = publisher
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        # topic -> JSON payload of all announced configs
+        self.configs = {}
+        # topic -> hash of the last published payload
+        self.published = {}
+        self.connected = False
+        if statefile and os.path.exists(statefile):
+            try:
+                with open(statefile, "r", encoding="utf8") as file_handle:
+                    self.published = json.load(file_handle)
+            except (OSError, ValueError) as e:
+                logging.warning("Cannot read discovery state %s: %s", statefile, e)
+
+    @staticmethod
+    def hash(payload):
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def announce(self, topic, configuration):
+        """Add or update the discovery config published to topic"""
+        payload = json.dumps(configuration)
+        with self.lock:
+            self.configs[topic] = payload
+            if not self.connected:
+                return
+            changed = self.publish_changed([topic])
+        if changed:
+            self.save()
+
+    def remove(self, topic):
+        """Remove a discovery config, deleting the retained message"""
+        with self.lock:
+            self.configs.pop(topic, None)
+            if self.published.pop(topic, None) is None:
+                return
+        self.publisher.publish(topic, payload="", retain=True)
+        self.save()
+
+    def publish_changed(self, topics, force=False):
+        """Publish the configs of topics that changed since the last publish"""
+        changed = 0
+        for topic in topics:
+            payload = self.configs[topic]
+            digest = self.hash(payload)
+            if force or self.published.get(topic) != digest:
+                self.publisher.publish(topic, payload=payload, retain=True)
+                self.published[topic] = digest
+                changed += 1
+        return changed
+
+    def on_connect(self):
+        """Publish all new and changed configs, called after CONNACK"""
+        with self.lock:
+            self.connected = True
+            changed = self.publish_changed(list(self.configs))
+        logging.info(
+            "Published %d discovery configs, %d unchanged", changed, len(self.configs) - changed
+        )
+        if changed:
+            self.save()
+
+    def on_status(self, message):
+        """Publish all configs again when Home Assistant (re)started"""
+        if message.payload.strip().lower() != STATUS_ONLINE:
+            return
+        with self.lock:
+            if not self.connected:
+                return
+            changed = self.publish_changed(list(self.configs), force=True)
+        logging.info("Home Assistant is online, published %d discovery configs", changed)
+        self.save()
+
+    def save(self):
+        """Atomically save the hashes of published configs"""
+        if not self.statefile:
+            return
+        with self.lock:
+            published = dict(self.published)
+        tmpfile = self.statefile + ".tmp"
+        try:
+            with open(tmpfile, "w", encoding="utf8") as file_handle:
+                json.dump(published, file_handle)
+            os.replace(tmpfile, self.statefile)
+        except OSError as e:
+            logging.warning("Cannot save discovery state %s: %s", self.statefile, e)
+
+
+def test_discovery(tmp_path):
+    from .testing import Message, RecordingPublisher
+
+    statefile = str(tmp_path / "discovery.json")
+    publisher = RecordingPublisher()
+    discovery = DiscoveryManager(publisher, statefile)
+    discovery.announce("a/config", {"name": "a"})
+    discovery.announce("b/config", {"name": "b"})
+    assert publisher.published == []
+    discovery.on_connect()
+    assert [topic for topic, _ in publisher.published] == ["a/config", "b/config"]
+
+    # after a restart, only changed configs are published
+    publisher = RecordingPublisher()
+    discovery = DiscoveryManager(publisher, statefile)
+    discovery.announce("a/config", {"name": "a"})
+    discovery.announce("b/config", {"name": "B"})
+    discovery.on_connect()
+    assert publisher.published == [("b/config", '{"name": "B"}')]
+    discovery.announce("c/config", {"name": "c"})
+    assert publisher.published[-1] == ("c/config", '{"name": "c"}')
+
+    # Home Assistant restarted
+    publisher.published.clear()
+    discovery.on_status(Message(b"online"))
+    assert len(publisher.published) == 3
+
+    discovery.remove("c/config")
+    assert publisher.published[-1] == ("c/config", "")
@@ -0,0 +1,188 @@
+"""
+Counters, gauges and histograms for the hot paths
+
+Metrics are disabled by default. Until enable() is called, the recording
+functions return immediately, so instrumentation costs one function call.
+When enabled, metrics can be scraped in the Prometheus text format from a
+local HTTP endpoint and/or published periodically as JSON via MQTT.
+"""
+
+import bisect
+import http.server
+import json
+import logging
+import threading
+
+enabled = False
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def inc(name, value=1, **labels):
+    """Increase counter"""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Record a value, e.g. a duration in seconds, in a histogram"""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def register_gauge(name, callback, **labels):
+    """Register a callable that returns the current value of a gauge"""
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = callback
+
+
+def unregister_gauge(name, **labels):
+    """Remove a gauge, e.g. of a component that is stopped"""
+    with _lock:
+        _gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+
+def format_name(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % label for label in labels))
+
+
+def collect_gauges():
+    with _lock:
+        gauges = list(_gauges.items())
+    values = {}
+    for key, callback in gauges:
+        try:
+            values[key] = callback()
+        except Exception as e:
+            logging.debug("cannot collect gauge %s: %s", key[0], e)
+    return values
+
+
+def snapshot():
+    """All metrics as a flat dict, e.g. for publishing as JSON"""
+    result = {format_name(*key): value for key, value in collect_gauges().items()}
+    with _lock:
+        for key, value in _counters.items():
+            result[format_name(*key)] = value
+        for key, histogram in _histograms.items():
+            result[format_name(*key)] = {
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], histogram.counts)),
+            }
+    return result
+
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for (name, labels), value in sorted(collect_gauges().items()):
+        lines.append("%s %s" % (format_name(name, labels), value))
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append("%s %s" % (format_name(name + "_total", labels), value))
+        for (name, labels), histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append("%s %d" % (
+                    format_name(name + "_bucket", labels + (("le", bound),)), cumulative
+                ))
+            lines.append("%s %s" % (format_name(name + "_sum", labels), histogram.sum))
+            lines.append("%s %d" % (format_name(name + "_count", labels), histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics request: " + format, *args)
+
+
+def start_http_server(host, port):
+    """Serve metrics at http://host:port/metrics from a background thread"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_mqtt_publisher(publisher, topic, interval):
+    """Publish a JSON snapshot of all metrics every interval seconds"""
+    def run():
+        while not stop.wait(interval):
+            publisher.publish(topic, payload=json.dumps(snapshot()), retain=False)
+
+    stop = threading.Event()
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+def test_metrics():
+    global enabled
+    inc("test_disabled")
+    assert "test_disabled" not in snapshot()
+    enabled = True
+    try:
+        inc("test_frames", protocol="lacrosse")
+        inc("test_frames", 2, protocol="lacrosse")
+        observe("test_write_seconds", 0.002)
+        register_gauge("test_depth", lambda: 3)
+        values = snapshot()
+        assert values['test_frames{protocol="lacrosse"}'] == 3
+        assert values["test_write_seconds"]["count"] == 1
+        assert values["test_depth"] == 3
+        text = prometheus_text()
+        assert 'test_frames_total{protocol="lacrosse"} 3' in text
+        assert 'test_write_seconds_bucket{le="0.0025"} 1' in text
+    finally:
+        enabled = False
+        _counters.clear()
+        _histograms.clear()
+        unregister_gauge("test_depth")
+        assert "test_depth" not in snapshot()
@@ -0,0 +1,150 @@
+"""
+Duty-cycle aware transmit pacing for CUL devices
+
+On 868 MHz, culfw enforces a 1% duty cycle. It keeps a send credit in units
+of 10 ms, which regenerates by one unit per second up to a maximum, and
+reports it as the second field of the "X" command reply. If a frame is sent
+without enough credit, culfw drops it and reports "LOVF".
+
+This module estimates the air time of each frame, tracks the remaining credit
+locally and resynchronizes it from periodic "X" polls, so that frames can be
+held back instead of being lost.
+"""
+
+import logging
+import re
+import threading
+import time
+
+# air time estimates in ms for one command, including culfw's repetitions
+AIRTIME_MS = {
+    # Somfy RTS: wake-up pulse, 6 frames of 56 bits at 1280 us plus syncs
+    b"Ys": 920,
+    # Intertechno: 6 repetitions of 24 bits at 1680 us plus sync
+    b"is": 320,
+}
+
+CREDIT_REPLY = re.compile(rb"^[0-9A-Fa-f]{2}\s+(\d+)$")
+
+
+class AirtimePacer:
+    """Track culfw send credit and decide when a frame may be sent"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.max_credit_ms = int(config.get("max_credit_ms", 9000))
+        self.regen_ms_per_s = int(config.get("credit_per_second_ms", 10))
+        self.poll_interval = int(config.get("credit_poll_interval", 60))
+        # keep a reserve, as our air time estimates are not exact
+        self.reserve_ms = int(config.get("reserve_ms", 200))
+
+        self.lock = threading.Lock()
+        self.credit_ms = self.max_credit_ms
+        self.updated = time.monotonic()
+        self.last_poll = 0
+        self.last_report = None
+        self.frames_sent = 0
+        self.frames_delayed = 0
+        self.airtime_sent_ms = 0
+        self.overflows = 0
+
+        # called with metrics() whenever the CUL reported its credit
+        self.on_update = None
+
+    @staticmethod
+    def airtime(command_string):
+        """Estimated air time in ms for a command string"""
+        return AIRTIME_MS.get(command_string[0:2], 0)
+
+    def regenerate(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.credit_ms = min(self.max_credit_ms, self.credit_ms + elapsed * self.regen_ms_per_s)
+
+    def delay(self, airtime_ms):
+        """Seconds to wait until a frame with the given air time may be sent"""
+        if not airtime_ms:
+            return 0
+        with self.lock:
+            self.regenerate()
+            missing = airtime_ms + self.reserve_ms - self.credit_ms
+        if missing <= 0:
+            return 0
+        return missing / self.regen_ms_per_s
+
+    def consume(self, airtime_ms):
+        """Account for a frame that has been handed to the CUL"""
+        if not airtime_ms:
+            return
+        with self.lock:
+            self.regenerate()
+            self.credit_ms -= airtime_ms
+            self.frames_sent += 1
+            self.airtime_sent_ms += airtime_ms
+
+    def mark_delayed(self):
+        with self.lock:
+            self.frames_delayed += 1
+
+    def poll_due(self):
+        """Return True if the credit should be polled with the "X" command"""
+        now = time.monotonic()
+        if now - self.last_poll < self.poll_interval:
+            return False
+        self.last_poll = now
+        return True
+
+    def on_rf_message(self, message):
+        """
+        Consume credit reports and overflow messages from the CUL
+
+        Returns True if the message was handled.
+        """
+        message = message.strip()
+        if message == b"LOVF":
+            logging.warning("CUL reported duty cycle overflow, frame was dropped")
+            with self.lock:
+                self.overflows += 1
+                self.credit_ms = 0
+                self.updated = time.monotonic()
+            return True
+        match = CREDIT_REPLY.match(message)
+        if not match:
+            return False
+        with self.lock:
+            self.credit_ms = int(match.group(1)) * 10
+            self.updated = time.monotonic()
+            self.last_report = self.updated
+        logging.debug("CUL send credit: %d ms", self.credit_ms)
+        if self.on_update:
+            self.on_update(self.metrics())
+        return True
+
+    def metrics(self):
+        """Current budget and counters as a dict"""
+        with self.lock:
+            self.regenerate()
+            return {
+                "credit_ms": int(self.credit_ms),
+                "max_credit_ms": self.max_credit_ms,
+                "frames_sent": self.frames_sent,
+                "frames_delayed": self.frames_delayed,
+                "airtime_sent_ms": self.airtime_sent_ms,
+                "overflows": self.overflows,
+            }
+
+
+def test_pacing():
+    pacer = AirtimePacer({"max_credit_ms": 1000, "reserve_ms": 0})
+    frame = b"YsA140100FB0C004\n"
+    assert pacer.airtime(frame) == 920
+    assert pacer.airtime(b"Nr1\n") == 0
+    assert pacer.delay(920) == 0
+    pacer.consume(920)
+    assert pacer.delay(920) > 0
+    assert pacer.on_rf_message(b"21  900")
+    assert pacer.metrics()["credit_ms"] == 1000
+    assert pacer.on_rf_message(b"LOVF")
+    assert pacer.metrics()["overflows"] == 1
+    assert not pacer.on_rf_message(b"N0199E6282EC7AAAA0000719199")
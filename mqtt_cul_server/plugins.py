@@ -0,0 +1,80 @@
+"""
+Registry of protocol plugins
+
+A protocol plugin is a class, which is only imported when its config section
+is enabled. The plugin name is the component name and the name of its config
+section. Besides the built-in protocols, third-party packages can provide
+protocols via the entry point group "mqtt_cul_server.protocols", e.g. in
+setup.py:
+
+    entry_points={"mqtt_cul_server.protocols": ["fs20 = mqtt_cul_fs20:FS20"]}
+
+A protocol class provides
+
+- create(cul, publisher, prefix, statedir, config, discovery): classmethod
+  returning the component
+- get_component_name(): classmethod returning the plugin name
+- get_topic_filters(): MQTT topic filters -> handler(message, *wildcards)
+- get_rf_handlers(): prefixes of received RF lines -> handler(line)
+"""
+
+import importlib
+import importlib.metadata
+import logging
+
+ENTRY_POINT_GROUP = "mqtt_cul_server.protocols"
+
+# name -> "module:class" of the protocols shipped with this package
+BUILTIN = {
+    "intertechno": "mqtt_cul_server.protocols.intertechno:Intertechno",
+    "somfy": "mqtt_cul_server.protocols.somfy_shutter:SomfyShutter",
+    "lacrosse": "mqtt_cul_server.protocols.lacrosse:LaCrosse",
+}
+
+
+def available():
+    """All known protocols as name -> "module:class", without importing them"""
+    protocols = dict(BUILTIN)
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name in protocols:
+            logging.warning(
+                "Ignoring protocol %s from %s, name already in use", entry_point.name, entry_point.value
+            )
+            continue
+        protocols[entry_point.name] = entry_point.value
+    return protocols
+
+
+def load(name, protocols=None):
+    """Import and return the class of a protocol"""
+    value = (protocols or available())[name]
+    module_name, _, class_name = value.partition(":")
+    protocol = getattr(importlib.import_module(module_name), class_name)
+    if protocol.get_component_name() != name:
+        raise ValueError("%s is registered as protocol %s" % (value, name))
+    return protocol
+
+
+def enabled(config):
+    """Names and classes of all protocols enabled in config, in order"""
+    protocols = available()
+    for name in protocols:
+        if config.has_section(name) and config[name].getboolean("enabled"):
+            yield name, load(name, protocols)
+
+
+def test_plugins():
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "intertechno": {"enabled": "no"},
+        "lacrosse": {"enabled": "yes"},
+    })
+    assert set(BUILTIN) <= set(available())
+    assert [(name, protocol.__name__) for name, protocol in enabled(config)] == [("lacrosse", "LaCrosse")]
+    try:
+        load("unknown")
+        assert False
+    except KeyError:
+        pass
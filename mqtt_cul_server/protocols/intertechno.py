@@ -5,10 +5,13 @@ This module implements the serial protocol of culfw for the Intertechno
 wireless communication protocol.
 """
 
-import json
 import logging
 import re
 
+from .. import metrics
+from ..discovery import DiscoveryManager
+from ..registry import DeviceRegistry
+
 
 class Intertechno:
     """
@@ -18,20 +21,61 @@ class Intertechno:
     wireless communication protocol.
     """
 
-    def __init__(self, cul, mqtt_client, prefix, config):
+    # each system can have exactly these 5 units
+    UNIT_IDS = ["0FFFF", "F0FFF", "FF0FF", "FFF0F", "FFFF0"]
+
+    # MQTT payloads and the command bits they send
+    COMMAND_BITS = {b"ON": "FF", b"OFF": "F0"}
+
+    DEVICENAME = re.compile(r"[0F]{10}")
+
+    class IntertechnoUnit:
+        __slots__ = ("devicename", "name", "frames")
+
+        def __init__(self, system_id, unit_id):
+            self.devicename = system_id + unit_id
+            self.name = "Intertechno " + system_id + " " + unit_id
+            # complete frames by MQTT payload, built once
+            self.frames = {
+                payload: Intertechno.command_string(self.devicename, bits)
+                for payload, bits in Intertechno.COMMAND_BITS.items()
+            }
+
+    def __init__(self, cul, mqtt_client, prefix, config, discovery=None):
         self.cul = cul
+        self.discovery = discovery or DiscoveryManager(mqtt_client)
 
-        self.system_id = config["system_id"]
+        self.system_id = None
         self.prefix = prefix
 
+        self.devices = DeviceRegistry()
+        self.reload(config)
+
+    def reload(self, config):
+        """Replace all units if the system ID changed"""
+        system_id = config["system_id"]
+        if system_id == self.system_id:
+            return
+        for unit in list(self.devices):
+            self.devices.remove(unit.devicename)
+            self.discovery.remove(self.prefix + "/switch/intertechno/" + unit.devicename + "/config")
+        self.system_id = system_id
+        for unit_id in self.UNIT_IDS:
+            unit = self.IntertechnoUnit(self.system_id, unit_id)
+            self.devices.add(unit.devicename, unit)
+
         # send messages for device discovery
-        self.send_discovery(mqtt_client)
+        self.send_discovery()
 
     @classmethod
     def get_component_name(cls):
         return "intertechno"
 
-    def send_discovery(self, mqtt_client):
+    @classmethod
+    def create(cls, cul, publisher, prefix, statedir, config, discovery):
+        return cls(cul, publisher, prefix, config, discovery)
+
+    def send_discovery(self):
         """
         Send Home Assistant - compatible discovery messages
 
@@ -43,9 +87,6 @@ class Intertechno:
         feedback about the state.
         """
 
-        # each system can have exactly these 5 units
-        unit_ids = ["0FFFF", "F0FFF", "FF0FF", "FFF0F", "FFFF0"]
-
         configuration = {
             "command_topic": "~/set",
             "payload_on": "ON",
@@ -53,50 +94,71 @@ class Intertechno:
             "optimistic": True,
         }
 
-        for unit_id in unit_ids:
-            base_prefix = (
-                self.prefix + "/switch/intertechno/" + self.system_id + unit_id
-            )
+        for unit in self.devices:
+            base_prefix = self.prefix + "/switch/intertechno/" + unit.devicename
             configuration["~"] = base_prefix
-            configuration["name"] = "Intertechno " + self.system_id + " " + unit_id
-            configuration["unique_id"] = "intertechno_" + self.system_id + unit_id
+            configuration["name"] = unit.name
+            configuration["unique_id"] = "intertechno_" + unit.devicename
 
             topic = base_prefix + "/config"
-            mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
+            self.discovery.announce(topic, configuration)
+
+    def get_topic_filters(self):
+        """MQTT topic filters handled by this component, with their handlers"""
+        return {self.prefix + "/switch/intertechno/+/set": self.on_message}
+
+    def get_rf_handlers(self):
+        # no RF messages are received, commands are fire-and-forget
+        return {}
+
+    @staticmethod
+    def command_string(devicename, commandbits):
+        """Frame switching a device, commandbits FF is on and F0 is off"""
+        return ("is" + devicename + commandbits + "\n").encode()
+
+    def on_message(self, message, devicename):
+        unit = self.devices.get(devicename)
+        if unit is None:
+            if self.DEVICENAME.fullmatch(devicename) is None:
+                raise ValueError("Intertechno device name does not match [0F]{10}")
+            if devicename[0:5] != self.system_id:
+                logging.info("Received command for different Intertechno system. Ignoring.")
+                return
+            # other unit codes of the system are not discovered, but can be used
+            unit = self.IntertechnoUnit(self.system_id, devicename[5:])
+
+        command_string = unit.frames.get(message.payload)
+        if command_string is None:
+            raise ValueError("Command %s is not supported", message.payload)
+
+        metrics.inc("commands_sent", protocol="intertechno", device=devicename)
+        self.send_command(command_string, devicename)
+
+    def send_command(self, command, devicename=None):
+        """Send command string, as str or bytes, via CUL device"""
+        if isinstance(command, str):
+            command = command.encode()
+        logging.debug("sending intertechno command %s", command)
+        return self.cul.route(devicename).send_command(command)
 
-    def on_message(self, message):
-        prefix, devicetype, component, devicename, topic = message.topic.split("/", 4)
-        command = message.payload.decode()
 
-        if prefix != self.prefix:
-            logging.info("Ignoring message due to prefix")
-            return
-        if devicetype != "switch":
-            raise ValueError("Intertechno can only handle switches")
-        if component != "intertechno":
-            raise ValueError("Received command for different component")
-        if re.match(r"^[0F]{10}$", devicename) is None:
-            raise ValueError("Intertechno device name does not match [0F]{10}")
-
-        if devicename[0:5] != self.system_id:
-            logging.info("Received command for different Intertechno system. Ignoring.")
-            return
+def test_frames():
+    from ..testing import Message
 
-        if topic == "set":
-            if command == "ON":
-                commandbits = "FF"
-            elif command == "OFF":
-                commandbits = "F0"
-            else:
-                raise ValueError("Command %s is not supported", command)
-
-            command = "is" + devicename + commandbits + "\n"
-            self.send_command(command)
-        else:
-            logging.debug("ignoring topic %s", topic)
-
-    def send_command(self, command):
-        """Send command string via CUL device"""
-        command_string = command.encode()
-        logging.debug("sending intertechno command %s", command)
-        self.cul.send_command(command_string)
+    sent = []
+
+    class Cul:
+        def route(self, _devicename):
+            return self
+
+        def send_command(self, command_string):
+            sent.append(command_string)
+
+    intertechno = Intertechno(Cul(), None, "homeassistant", {"system_id": "0F0FF"})
+    intertechno.on_message(Message(b"ON"), "0F0FFF0FFF")
+    intertechno.on_message(Message(b"OFF"), "0F0FFF0FFF")
+    # other systems are ignored
+    intertechno.on_message(Message(b"OFF"), "FFFFFF0FFF")
+    # units of the system which are not discovered are switched as well
+    intertechno.on_message(Message(b"OFF"), "0F0FF00FFF")
+    assert sent == [b"is0F0FFF0FFFFF\n", b"is0F0FFF0FFFF0\n", b"is0F0FF00FFFF0\n"]
@@ -1,7 +1,47 @@
 import json
 import logging
+import threading
+import time
 
-from .. import cul
+from .. import cul, metrics, rxmodes, stats
+from ..discovery import DiscoveryManager
+from ..publisher import POLICY_SPOOL
+from ..registry import DeviceRegistry
+
+
+def _crc_table():
+    """CRC-8 lookup table for poly = 0x31"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31 if crc & 0x80 else crc << 1) & 0xff
+        table.append(crc)
+    return tuple(table)
+
+
+# precomputed tables for the fast decoding path
+CRC_TABLE = _crc_table()
+# value of an ASCII hex digit, 0x100 marks invalid characters
+HEX_TABLE = tuple(
+    int(chr(c), 16) if chr(c) in "0123456789abcdefABCDEF" else 0x100 for c in range(256)
+)
+# temperature for the 3 BCD digits sent by the sensor
+TEMPERATURE_TABLE = tuple(round(value / 10 - 40, 1) for value in range(1000))
+
+FRAME_LENGTH = 27
+# with RSSI reporting enabled, culfw appends the RSSI as two hex digits
+RSSI_FRAME_LENGTH = 29
+START_MARKER = ord("9")
+NO_HUMIDITY = 106
+
+
+def crc8(data):
+    """CRC-8 with poly = 0x31 via CRC_TABLE, same result as LaCrosse.crc"""
+    crc = 0
+    for byte in data:
+        crc = CRC_TABLE[crc ^ byte]
+    return crc
 
 
 class LaCrosse:
@@ -17,22 +57,121 @@ class LaCrosse:
 
     """
 
-    def __init__(self, cul, mqtt_client, prefix):
+    class SensorState:
+        """Last received and last published reading and link stats of a sensor"""
+
+        __slots__ = (
+            "id", "published", "published_at", "received", "received_at",
+            "rssi", "link_quality", "last_seen", "stats",
+        )
+
+        def __init__(self, sensor_id):
+            self.id = sensor_id
+            self.published = None
+            self.published_at = 0
+            self.received = None
+            self.received_at = 0
+            # RSSI in dBm of the strongest copy of the last reading
+            self.rssi = None
+            # percentage of expected transmissions received, smoothed
+            self.link_quality = 100.0
+            self.last_seen = None
+            # quantity -> RollingStats, if statistics are enabled
+            self.stats = None
+
+    def __init__(self, cul, mqtt_client, prefix, config=None, discovery=None):
         self.cul = cul
         self.prefix = prefix
         self.mqtt_client = mqtt_client
-        self.devices = []
+        self.discovery = discovery or DiscoveryManager(mqtt_client)
+        self.devices = DeviceRegistry()
+
+        config = config or {}
+        self.reload(config)
+        # time source in seconds, the capture time when replaying a capture
+        self.clock = time.monotonic
+        # set when the protocol is disabled, to end its threads
+        self.stopped = threading.Event()
+        # (sensor id, reading) -> [strongest RSSI, number of copies, receive
+        # time], in order of arrival, flushed by one thread started on first use
+        self.pending = {}
+        self.pending_condition = threading.Condition()
+        self.flusher = None
+        # publish min, max and mean over rolling windows every stats_interval
+        # seconds. 0 disables statistics.
+        self.stats_interval = float(config.get("stats_interval", 0))
+        self.stats_thread = None
+        if self.stats_interval:
+            self.stats_thread = threading.Thread(target=self.publish_stats_loop, daemon=True)
+            self.stats_thread.start()
+        # native receive modes, e.g. Nr2 for 9.579 kbps sensors. With several
+        # modes, the CUL switches between them.
+        self.receive_modes = [m.strip() for m in config.get("receive_modes", "Nr1").split(",") if m.strip()]
+        self.scheduler = None
+        if len(self.receive_modes) > 1:
+            self.scheduler = rxmodes.ReceiveModeScheduler(
+                cul, self.receive_modes,
+                float(config.get("receive_mode_min_dwell", 10)),
+                float(config.get("receive_mode_cycle", 60)),
+            )
+
         self.set_listening_mode()
 
+    def reload(self, config):
+        """
+        Apply the publishing thresholds of config. Sensors are discovered
+        when received, so there are no devices to update. Statistics and
+        receive modes are only changed by a restart.
+        """
+        config = config or {}
+        # publish only if a value changed by at least the deadband ...
+        self.temperature_deadband = float(config.get("temperature_deadband", 0))
+        self.humidity_deadband = float(config.get("humidity_deadband", 0))
+        # ... or if the last publish is older than heartbeat seconds.
+        # 0 publishes every received frame.
+        self.heartbeat = float(config.get("heartbeat", 0))
+        # identical frames within this many seconds belong to the same burst
+        self.burst_window = float(config.get("burst_window", 1))
+        # copies of a reading received within this many seconds, e.g. by
+        # several CULs, are published once with the strongest RSSI. 0 disables
+        # this and publishes each reading immediately.
+        self.diversity_window = float(config.get("diversity_window", 0))
+        # interval in seconds at which sensors transmit, for link quality
+        self.transmit_interval = float(config.get("transmit_interval", 4))
+
     @classmethod
     def get_component_name(cls):
         return "lacrosse"
 
+    @classmethod
+    def create(cls, cul, publisher, prefix, statedir, config, discovery):
+        return cls(cul, publisher, prefix, config, discovery)
+
     def set_listening_mode(self):
-        """Enable listening for Native RF mode 1"""
-        command_string = "Nr1\n".encode()
-        self.cul.send_command(command_string)
+        """Enable listening in the native receive mode(s)"""
+        if self.scheduler:
+            self.scheduler.start()
+        else:
+            self.cul.set_receive_mode(self.receive_modes[0].encode() + b"\n")
 
+    def stop(self):
+        """
+        End all threads and stop returning to the receive mode(s). Readings
+        still waiting for more copies are handled right away.
+        """
+        self.stopped.set()
+        if self.scheduler:
+            self.scheduler.stop()
+        with self.pending_condition:
+            self.pending_condition.notify()
+        for thread in (self.flusher, self.stats_thread):
+            if thread:
+                thread.join()
+        with self.pending_condition:
+            pending, self.pending = self.pending, {}
+        for key, (rssi, _, received) in pending.items():
+            self.on_reading(key[1], rssi, received)
+        self.cul.set_receive_mode(None)
 
     def send_discovery(self, parsed_data):
         """
@@ -42,8 +181,6 @@ class LaCrosse:
         https://www.home-assistant.io/docs/mqtt/discovery/
         https://www.home-assistant.io/integrations/sensor.mqtt/
         """
-        # register id as known to not send discovery every time
-        self.devices.append(parsed_data["id"])
         unit_id = str(parsed_data["id"])
         # temperature
         configuration = {
@@ -62,7 +199,7 @@ class LaCrosse:
             },
         }
         topic = self.prefix + "/sensor/lacrosse/" + unit_id + "_temperature/config"
-        self.mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
+        self.discovery.announce(topic, configuration)
         # humidity
         configuration = {
             "device_class": "humidity",
@@ -80,7 +217,7 @@ class LaCrosse:
             },
         }
         topic = self.prefix + "/sensor/lacrosse/" + unit_id + "_humidity/config"
-        self.mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
+        self.discovery.announce(topic, configuration)
         # battery
         configuration = {
             "device_class": "battery",
@@ -97,7 +234,57 @@ class LaCrosse:
             },
         }
         topic = self.prefix + "/sensor/lacrosse/" + unit_id + "_battery/config"
-        self.mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
+        self.discovery.announce(topic, configuration)
+        # link quality
+        self.send_diagnostic_discovery(unit_id, "link_quality", "Link Quality", "%")
+        if self.stats_interval:
+            self.send_stats_discovery(unit_id)
+
+    def send_stats_discovery(self, unit_id):
+        """Send discovery messages for the rolling statistics of a sensor"""
+        for quantity, unit in (("temperature", "°C"), ("humidity", "%")):
+            for window, _ in stats.WINDOWS:
+                for aggregate in ("min", "max", "mean"):
+                    key = quantity + "_" + window + "_" + aggregate
+                    configuration = {
+                        "device_class": quantity,
+                        "state_class": "measurement",
+                        "name": "LaCrosse " + unit_id + " " + quantity.capitalize() + " " + window + " " + aggregate,
+                        "unique_id": "lacrosse_" + unit_id + "_" + key,
+                        "unit_of_measurement": unit,
+                        "state_topic": self.prefix + "/sensor/lacrosse/" + unit_id + "/stats",
+                        "value_template": "{{value_json." + key + "}}",
+                        "device": {
+                            "name": "Temperatur / Luftfeuchtesensor " + unit_id,
+                            "identifiers": "lacrosse_" + unit_id,
+                            "model": "TX29 DTH-IT",
+                            "manufacturer": "LaCrosse"
+                        },
+                    }
+                    topic = self.prefix + "/sensor/lacrosse/" + unit_id + "_" + key + "/config"
+                    self.discovery.announce(topic, configuration)
+
+    def send_diagnostic_discovery(self, unit_id, key, name, unit, device_class=None):
+        """Send discovery message for a reception statistic of a sensor"""
+        configuration = {
+            "entity_category": "diagnostic",
+            "state_class": "measurement",
+            "name": "LaCrosse " + unit_id + " " + name,
+            "unique_id": "lacrosse_" + unit_id + "_" + key,
+            "unit_of_measurement": unit,
+            "state_topic": self.prefix + "/sensor/lacrosse/" + unit_id + "/state",
+            "value_template": "{{value_json." + key + "}}",
+            "device": {
+                "name": "Temperatur / Luftfeuchtesensor " + unit_id,
+                "identifiers": "lacrosse_" + unit_id,
+                "model": "TX29 DTH-IT",
+                "manufacturer": "LaCrosse"
+            },
+        }
+        if device_class:
+            configuration["device_class"] = device_class
+        topic = self.prefix + "/sensor/lacrosse/" + unit_id + "_" + key + "/config"
+        self.discovery.announce(topic, configuration)
 
     def crc(self, data):
         """calculate CRC-8 with poly = 0x31 """
@@ -130,6 +317,7 @@ class LaCrosse:
             received_crc = int(data[CRC][0]+data[CRC][1], base=16)
             calculated_crc = self.crc(bytes.fromhex(data[ALL_DATA]))
             if received_crc != calculated_crc:
+                metrics.inc("lacrosse_crc_errors")
                 raise ValueError(f"CRC failure: received 0x{received_crc:08b}, " \
                                  f"calculated 0x{calculated_crc:08b}")
             parsed_data["id"] = (int(data[ID], base=16) & 0x3F) >> 2
@@ -152,24 +340,294 @@ class LaCrosse:
             parsed_data = {}
         return parsed_data
 
-    def on_message(self, message):
-        # ignore MQTT commands for lacrosse, it is RF receive-only, no commands
-        pass
+    @staticmethod
+    def decode_rx_bytes(line):
+        """
+        Decode a raw received line without intermediate strings
+
+        Returns a tuple (id, temperature, humidity, battery) or None if the
+        line can't be decoded. humidity is None if the sensor has none.
+        Gives the same results as decode_rx_data, which is kept for reporting
+        the reason of decode errors.
+        """
+        length = len(line)
+        while length and line[length - 1] in (10, 13):
+            length -= 1
+        if (length != FRAME_LENGTH and length != RSSI_FRAME_LENGTH) or line[3] != START_MARKER:
+            return None
+        h = HEX_TABLE
+        d4, d5, d6, d7, d8 = h[line[4]], h[line[5]], h[line[6]], h[line[7]], h[line[8]]
+        d9, d10, d11, d12 = h[line[9]], h[line[10]], h[line[11]], h[line[12]]
+        if (d4 | d5 | d6 | d7 | d8 | d9 | d10 | d11 | d12) & 0x100:
+            return None
+        # temperature digits are BCD
+        if d6 > 9 or d7 > 9 or d8 > 9:
+            return None
+        t = CRC_TABLE
+        crc = t[t[t[t[0x90 | d4] ^ (d5 << 4 | d6)] ^ (d7 << 4 | d8)] ^ (d9 << 4 | d10)]
+        if crc != d11 << 4 | d12:
+            return None
+        sensor_id = d4 << 4 | d5
+        humidity = (d9 << 4 | d10) & 0x7F
+        if humidity == NO_HUMIDITY:
+            humidity = None
+        # the weak battery flag is not evaluated, same as in decode_rx_data
+        battery = 100 if sensor_id & 0x2 else 50
+        return (
+            (sensor_id & 0x3F) >> 2,
+            TEMPERATURE_TABLE[d6 * 100 + d7 * 10 + d8],
+            humidity,
+            battery,
+        )
+
+    @staticmethod
+    def rssi(line):
+        """RSSI in dBm appended by culfw to a received line, or None"""
+        line = line.rstrip(b"\r\n")
+        if len(line) != RSSI_FRAME_LENGTH:
+            return None
+        high, low = HEX_TABLE[line[-2]], HEX_TABLE[line[-1]]
+        if (high | low) & 0x100:
+            return None
+        raw = high << 4 | low
+        # conversion as documented for the CC1101 transceiver of the CUL
+        if raw >= 128:
+            raw -= 256
+        return raw / 2 - 74
+
+    @classmethod
+    def decode_batch(cls, lines):
+        """
+        Decode many frames at once
+
+        lines is a list of raw lines or a buffer with newline separated
+        frames. Returns a list with the result of decode_rx_bytes per line.
+        """
+        if isinstance(lines, (bytes, bytearray, memoryview)):
+            lines = bytes(lines).splitlines()
+        decode = cls.decode_rx_bytes
+        return [decode(line) for line in lines]
+
+    @staticmethod
+    def decode_batch_numpy(lines):
+        """
+        Decode many frames at once with NumPy, e.g. for replayed captures
+
+        Returns a structured array with the fields valid, id, temperature,
+        humidity and battery, one row per line. humidity is -1 if the sensor
+        has none. Requires the optional numpy package.
+        """
+        # imported here, as it is slow to import and only needed offline
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("decode_batch_numpy requires numpy") from None
+        if isinstance(lines, (bytes, bytearray, memoryview)):
+            lines = bytes(lines).splitlines()
+        # same lengths as accepted by decode_rx_bytes, without the RSSI
+        lines = [
+            line[0:FRAME_LENGTH] if len(line) in (FRAME_LENGTH, RSSI_FRAME_LENGTH) else b""
+            for line in (line.rstrip(b"\r\n") for line in lines)
+        ]
+        result = numpy.zeros(len(lines), dtype=[
+            ("valid", "?"), ("id", "u1"), ("temperature", "f4"), ("humidity", "i2"), ("battery", "u1"),
+        ])
+        rows = numpy.array([len(line) == FRAME_LENGTH for line in lines], dtype=bool)
+        if not rows.any():
+            return result
+        frames = numpy.frombuffer(
+            b"".join(line for line in lines if len(line) == FRAME_LENGTH), dtype=numpy.uint8
+        ).reshape(-1, FRAME_LENGTH)
+
+        d = numpy.array(HEX_TABLE, dtype=numpy.uint16)[frames[:, 3:13]]
+        valid = (frames[:, 3] == START_MARKER) & ~((d & 0x100).any(axis=1))
+        valid &= (d[:, 3:6] <= 9).all(axis=1)
+        d &= 0xF
+        t = numpy.array(CRC_TABLE, dtype=numpy.uint16)
+        crc = t[0x90 | d[:, 1]]
+        crc = t[crc ^ (d[:, 2] << 4 | d[:, 3])]
+        crc = t[crc ^ (d[:, 4] << 4 | d[:, 5])]
+        crc = t[crc ^ (d[:, 6] << 4 | d[:, 7])]
+        valid &= crc == (d[:, 8] << 4 | d[:, 9])
+
+        sensor_id = d[:, 1] << 4 | d[:, 2]
+        humidity = ((d[:, 6] << 4 | d[:, 7]) & 0x7F).astype(numpy.int16)
+        humidity[humidity == NO_HUMIDITY] = -1
+        bcd = numpy.minimum(d[:, 3:6], 9)
+        temperature = numpy.array(TEMPERATURE_TABLE, dtype=numpy.float32)[
+            bcd[:, 0] * 100 + bcd[:, 1] * 10 + bcd[:, 2]
+        ]
+
+        result["valid"][rows] = valid
+        result["id"][rows] = (sensor_id & 0x3F) >> 2
+        result["temperature"][rows] = temperature
+        result["humidity"][rows] = humidity
+        result["battery"][rows] = numpy.where(sensor_id & 0x2, 100, 50)
+        result[~result["valid"]] = 0
+        return result
+
+    def get_topic_filters(self):
+        # lacrosse is RF receive-only, there are no MQTT commands
+        return {}
+
+    def get_rf_handlers(self):
+        """Prefixes of received RF messages handled by this component"""
+        return {
+            rxmodes.ReceiveModeScheduler.line_prefix(mode): self.on_rf_message
+            for mode in self.receive_modes
+        }
+
+    def should_publish(self, sensor, decoded, now):
+        """
+        Decide whether a reading is worth publishing and update the cache
+
+        Duplicates within the same transmission burst are dropped. Other
+        readings are published if temperature or humidity moved past their
+        deadband, the battery state changed or the heartbeat expired.
+        """
+        if sensor.received == decoded and now - sensor.received_at < self.burst_window:
+            return False
+        sensor.received = decoded
+        sensor.received_at = now
+
+        last = sensor.published
+        if last is not None and self.heartbeat and now - sensor.published_at < self.heartbeat:
+            _, temperature, humidity, battery = decoded
+            _, last_temperature, last_humidity, last_battery = last
+            if battery == last_battery \
+                    and round(abs(temperature - last_temperature), 1) < self.temperature_deadband \
+                    and (humidity == last_humidity or (
+                        humidity is not None and last_humidity is not None
+                        and abs(humidity - last_humidity) < self.humidity_deadband)):
+                return False
+        sensor.published = decoded
+        sensor.published_at = now
+        return True
 
     def on_rf_message(self, message):
-        decoded = self.decode_rx_data(message.strip())
-        if "id" not in decoded:
-            # message could not be decoded, ignore
+        if self.scheduler:
+            self.scheduler.on_rf_message(message)
+        decoded = self.decode_rx_bytes(message)
+        if decoded is None:
+            # message could not be decoded, log reason and ignore
+            metrics.inc("rf_decode_errors", protocol="lacrosse")
+            self.decode_rx_data(message.decode(errors="replace").strip()[0:FRAME_LENGTH])
             return
-        if decoded["id"] not in self.devices:
-            logging.info("sending discovery for %d", decoded["id"])
-            self.send_discovery(decoded)
-        else:
-            logging.debug("known devices: %s", str(self.devices))
-        topic = self.prefix + "/sensor/lacrosse/" + str(decoded["id"]) + "/state"
-        del decoded["id"]
-        self.mqtt_client.publish(topic, payload=json.dumps(decoded), retain=False)
+        metrics.inc("rf_frames_decoded", protocol="lacrosse")
+        rssi = self.rssi(message)
+        now = self.clock()
+        if not self.diversity_window:
+            self.on_reading(decoded, rssi, now)
+            return
+
+        key = (decoded[0], decoded)
+        with self.pending_condition:
+            pending = self.pending.get(key)
+            if pending is not None and now - pending[2] < self.diversity_window:
+                # another copy of a reading we are already waiting on
+                metrics.inc("rf_duplicates", protocol="lacrosse")
+                if rssi is not None and (pending[0] is None or rssi > pending[0]):
+                    pending[0] = rssi
+                pending[1] += 1
+                return
+            if pending is not None:
+                # its window closed before the flusher got to it, e.g. when
+                # replaying a capture faster than real time
+                del self.pending[key]
+            self.pending[key] = [rssi, 1, now]
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_pending, daemon=True)
+                self.flusher.start()
+            elif len(self.pending) == 1:
+                self.pending_condition.notify()
+        if pending is not None:
+            self.on_reading(decoded, pending[0], pending[2])
+
+    def flush_pending(self):
+        """Handle the strongest copy of each reading once its window closed"""
+        while not self.stopped.is_set():
+            with self.pending_condition:
+                while not self.pending and not self.stopped.is_set():
+                    self.pending_condition.wait()
+                if self.stopped.is_set():
+                    return
+                # the oldest reading is the next one due
+                key, (rssi, copies, received) = next(iter(self.pending.items()))
+                delay = received + self.diversity_window - self.clock()
+                if delay > 0:
+                    self.pending_condition.wait(delay)
+                    continue
+                del self.pending[key]
+            logging.debug("received %d copies of reading %s", copies, key[1])
+            self.on_reading(key[1], rssi, received)
 
+    def update_link_stats(self, sensor, rssi, now):
+        """Update RSSI and the estimated share of transmissions received"""
+        if rssi is not None:
+            if sensor.rssi is None:
+                self.send_diagnostic_discovery(
+                    str(sensor.id), "rssi", "Signal Strength", "dBm", "signal_strength"
+                )
+            sensor.rssi = rssi
+        if sensor.last_seen is not None and now - sensor.last_seen > self.burst_window:
+            expected = max(1, round((now - sensor.last_seen) / self.transmit_interval))
+            sensor.link_quality += 0.1 * (100 / expected - sensor.link_quality)
+        sensor.last_seen = now
+
+    def on_reading(self, decoded, rssi, now=None):
+        """Handle a decoded reading, received with the given RSSI at time now"""
+        sensor_id, temperature, humidity, battery = decoded
+        if now is None:
+            now = self.clock()
+        sensor = self.devices.get(sensor_id)
+        if sensor is None:
+            # register id as known to not send discovery every time
+            sensor = self.devices.add(sensor_id, self.SensorState(sensor_id))
+            logging.info("sending discovery for %d", sensor_id)
+            self.send_discovery({"id": sensor_id})
+        self.update_link_stats(sensor, rssi, now)
+        if self.stats_interval:
+            if sensor.stats is None:
+                sensor.stats = {"temperature": stats.RollingStats(), "humidity": stats.RollingStats()}
+            sensor.stats["temperature"].add(temperature, now)
+            if humidity is not None:
+                sensor.stats["humidity"].add(humidity, now)
+        if not self.should_publish(sensor, decoded, now):
+            metrics.inc("lacrosse_publishes_suppressed")
+            return
+        state = {"temperature": temperature}
+        if humidity is not None:
+            state["humidity"] = humidity
+        state["battery"] = battery
+        state["link_quality"] = round(sensor.link_quality)
+        if sensor.rssi is not None:
+            state["rssi"] = sensor.rssi
+        topic = self.prefix + "/sensor/lacrosse/" + str(sensor_id) + "/state"
+        # spooled to disk while the broker is unreachable, if enabled
+        self.mqtt_client.publish(topic, payload=json.dumps(state), retain=False, policy=POLICY_SPOOL)
+
+    def stats_state(self, sensor, now):
+        """
+        Rolling statistics of a sensor as state dict. Windows without
+        readings are None, so that every discovered key is always present.
+        """
+        state = {}
+        for quantity, series in sensor.stats.items():
+            for window, minutes in stats.WINDOWS:
+                aggregates = series.aggregate(minutes, now) or (None, None, None)
+                for aggregate, value in zip(("min", "max", "mean"), aggregates):
+                    state[quantity + "_" + window + "_" + aggregate] = None if value is None else round(value, 1)
+        return state
+
+    def publish_stats_loop(self):
+        """Publish the rolling statistics of all sensors every stats_interval"""
+        while not self.stopped.wait(self.stats_interval):
+            now = self.clock()
+            for sensor in list(self.devices):
+                if sensor.stats is None:
+                    continue
+                topic = self.prefix + "/sensor/lacrosse/" + str(sensor.id) + "/stats"
+                self.mqtt_client.publish(topic, payload=json.dumps(self.stats_state(sensor, now)), retain=False)
 
 def test_decode_data():
     """Test LaCrosse data parsing"""
@@ -204,6 +662,9 @@ def test_crc():
         assert lacrosse.decode_rx_data(m)
     for m in bad_messages:
         assert not lacrosse.decode_rx_data(m)
+    for m in good_messages + bad_messages:
+        data = bytes.fromhex(m[3:11])
+        assert crc8(data) == lacrosse.crc(data)
 
 def test_real_data():
     cul_device = cul.Cul("", test=True)
@@ -216,3 +677,149 @@ def test_real_data():
     ]
     for m in messages:
         logging.info(lacrosse.decode_rx_data(m))
+
+def test_decode_rx_bytes():
+    cul_device = cul.Cul("", test=True)
+    lacrosse = LaCrosse(cul_device, None, None)
+    messages = [
+        "N0199E6282EC7AAAA0000719199",
+        "N019986373FC9AAAA0000000783",
+        "N019EC615414BAAAA0000571601",
+        "N019986373EF8AAAA000002B204",
+        "N019ECE33398CAAAA0000A17C69",
+        "N019A864143B1AAAA00000B3897",
+        "N019A86414280AAAA0000090092",
+        "N019A86414280AAAA000009009",
+        "N018A86414280AAAA0000090092",
+    ]
+    for m in messages:
+        expected = lacrosse.decode_rx_data(m)
+        decoded = LaCrosse.decode_rx_bytes(m.encode() + b"\r\n")
+        if not expected:
+            assert decoded is None
+            continue
+        assert decoded == (
+            expected["id"], expected["temperature"], expected.get("humidity"), expected["battery"]
+        )
+    assert LaCrosse.decode_batch("\n".join(messages).encode()) == [
+        LaCrosse.decode_rx_bytes(m.encode()) for m in messages
+    ]
+
+def test_should_publish():
+    cul_device = cul.Cul("", test=True)
+    config = {"temperature_deadband": "0.2", "humidity_deadband": "2", "heartbeat": "300"}
+    lacrosse = LaCrosse(cul_device, None, None, config)
+    sensor = LaCrosse.SensorState(7)
+    reading = (7, 22.8, 46, 100)
+    assert lacrosse.should_publish(sensor, reading, 0)
+    # duplicate within the same burst
+    assert not lacrosse.should_publish(sensor, reading, 0.1)
+    assert not lacrosse.should_publish(sensor, (7, 22.9, 47, 100), 4)
+    assert lacrosse.should_publish(sensor, (7, 23.0, 46, 100), 8)
+    assert lacrosse.should_publish(sensor, (7, 23.0, 48, 100), 12)
+    assert lacrosse.should_publish(sensor, (7, 23.0, 48, 50), 16)
+    assert not lacrosse.should_publish(sensor, (7, 23.0, 48, 50), 20)
+    # heartbeat
+    assert lacrosse.should_publish(sensor, (7, 23.0, 48, 50), 317)
+
+
+def test_diversity():
+    from ..testing import RecordingPublisher
+
+    cul_device = cul.Cul("", test=True)
+    client = RecordingPublisher()
+    lacrosse = LaCrosse(cul_device, client, "homeassistant", {"diversity_window": "0.05"})
+    assert LaCrosse.rssi(b"N0199E6282EC7AAAA0000719199") is None
+    assert LaCrosse.rssi(b"N0199E6282EC7AAAA000071919920\r\n") == -58
+    assert LaCrosse.rssi(b"N0199E6282EC7AAAA0000719199F0") == -82
+    for rssi in (b"F0", b"20", b"E0"):
+        lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199" + rssi)
+    flusher = lacrosse.flusher
+    lacrosse.on_rf_message(b"N019986373FC9AAAA0000000783")
+    time.sleep(0.2)
+    assert client.payloads("/state") == [
+        {"temperature": 22.8, "humidity": 46, "battery": 100, "link_quality": 100, "rssi": -58},
+        {"temperature": 23.7, "humidity": 63, "battery": 50, "link_quality": 100},
+    ]
+    # all readings are flushed by the same thread
+    assert lacrosse.flusher is flusher
+
+
+def test_stats():
+    from ..testing import RecordingPublisher
+
+    lacrosse = LaCrosse(cul.Cul("", test=True), RecordingPublisher(), "homeassistant", {"stats_interval": "3600"})
+    for temperature in (22.8, 23.0, 23.2):
+        lacrosse.on_reading((9, temperature, 46, 100), None)
+    state = lacrosse.stats_state(lacrosse.devices.get(9), time.monotonic())
+    assert state["temperature_5m_min"] == 22.8
+    assert state["temperature_24h_max"] == 23.2
+    assert state["temperature_1h_mean"] == 23.0
+    assert state["humidity_5m_mean"] == 46
+    # a sensor without humidity, and windows without readings, keep all keys
+    lacrosse.on_reading((10, 21.5, None, 100), None)
+    state = lacrosse.stats_state(lacrosse.devices.get(10), time.monotonic())
+    assert len(state) == 18
+    assert state["humidity_24h_max"] is None and state["temperature_5m_max"] == 21.5
+    state = lacrosse.stats_state(lacrosse.devices.get(10), time.monotonic() + 600)
+    assert state["temperature_5m_min"] is None and state["temperature_1h_min"] == 21.5
+
+
+def test_stop():
+    from ..testing import RecordingPublisher
+
+    cul_device = cul.Cul("", test=True)
+    lacrosse = LaCrosse(cul_device, RecordingPublisher(), "homeassistant", {
+        "stats_interval": "3600", "diversity_window": "10", "receive_modes": "Nr1, Nr2",
+    })
+    lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    threads = [lacrosse.flusher, lacrosse.stats_thread, lacrosse.scheduler.thread]
+    assert all(thread.is_alive() for thread in threads)
+    lacrosse.stop()
+    assert not any(thread.is_alive() for thread in threads)
+    assert cul_device.receive_mode is None
+    # the reading waiting for more copies is not lost
+    assert lacrosse.mqtt_client.payloads("/state")[0]["temperature"] == 22.8
+
+
+def test_replay_clock():
+    from ..testing import RecordingPublisher
+
+    now = [1000.0]
+    lacrosse = LaCrosse(cul.Cul("", test=True), RecordingPublisher(), "homeassistant", {
+        "heartbeat": "60", "diversity_window": "10",
+    })
+    lacrosse.clock = lambda: now[0]
+    lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    # the same reading 5 minutes later in capture time, replayed right away,
+    # is neither a copy of the first one nor suppressed by the heartbeat
+    now[0] += 300
+    lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    lacrosse.stop()
+    assert len(lacrosse.mqtt_client.payloads("/state")) == 2
+    assert lacrosse.devices.get(7).last_seen == 1300
+
+
+def test_decode_batch_numpy():
+    import pytest
+
+    pytest.importorskip("numpy")
+    messages = [
+        b"N0199E6282EC7AAAA0000719199\r\n",
+        b"N019ECE33398CAAAA0000A17C69\r\n",
+        b"garbage",
+        b"N019986373FC9AAAA0000000783\r\n",
+        # with RSSI, trailing garbage, truncated
+        b"N019986373FC9AAAA000000078320\r\n",
+        b"N019986373FC9AAAA0000000783X\r\n",
+        b"N019986373FC9AAAA00000007831234\r\n",
+        b"N019986373FC9AAAA000000078\r\n",
+    ]
+    decoded = LaCrosse.decode_batch_numpy(messages)
+    for row, m in zip(decoded, messages):
+        expected = LaCrosse.decode_rx_bytes(m)
+        assert row["valid"] == (expected is not None)
+        if expected:
+            sensor_id, temperature, humidity, battery = expected
+            assert (row["id"], row["humidity"], row["battery"]) == (sensor_id, humidity, battery)
+            assert abs(row["temperature"] - temperature) < 0.01
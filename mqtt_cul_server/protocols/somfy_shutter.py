@@ -8,6 +8,19 @@ wireless communication protocol.
 import json
 import logging
 import os
+import threading
+
+from .. import cul, metrics
+from ..discovery import DiscoveryManager
+from ..registry import DeviceRegistry
+
+HEX_DIGITS = b"0123456789ABCDEF"
+# two hex digits of each byte value
+HEX_BYTES = [b"%02X" % value for value in range(256)]
+# contribution of a character to the checksum, see calculate_checksum
+CHAR_CHECKSUM = bytes((char ^ char >> 4) & 0xF for char in range(256))
+DIGIT_CHECKSUM = bytes(CHAR_CHECKSUM[digit] for digit in HEX_DIGITS)
+BYTE_CHECKSUM = bytes(CHAR_CHECKSUM[digits[0]] ^ CHAR_CHECKSUM[digits[1]] for digits in HEX_BYTES)
 
 
 class SomfyShutter:
@@ -19,44 +32,178 @@ class SomfyShutter:
     """
 
     class SomfyShutterState:
-        def __init__(self, statedir, statefile):
+        """
+        State of a Somfy remote channel, stored as JSON file
+
+        Rolling codes are reserved in blocks: the rolling code stored in the
+        statefile is the first code of the next block, so that most button
+        presses need no disk I/O. The first block is reserved on first use.
+        After a crash, sending resumes after the reserved block, skipping
+        codes that might already have been used. State files of older
+        versions, which stored the next code to use, are read unchanged.
+        """
+
+        __slots__ = ("statefile", "state", "block_size", "reserved", "lock", "frame", "frame_checksum")
+
+        def __init__(self, statedir, statefile, block_size=16):
             self.statefile = statedir + "/somfy/" + statefile
             with open(self.statefile, "r", encoding='utf8') as file_handle:
                 self.state = json.loads(file_handle.read())
+            self.block_size = block_size
+            # rolling codes are used by the CUL writer thread, reserved by others
+            self.lock = threading.Lock()
+            # nothing reserved until the first use, so that restarts without
+            # button presses don't move the rolling code ahead of the motor
+            self.reserved = self.state["rolling_code"]
+            self.build_frame()
 
-        def save(self):
-            """Save state to JSON file"""
-            with open(self.statefile, "w", encoding='utf8') as file_handle:
-                json.dump(self.state, file_handle)
+        def build_frame(self):
+            """
+            Prepare the frame template "YsAKCSRRRRSSSSSS\\n", of which only
+            key, command, checksum and rolling code change from frame to frame
+            """
+            address = self.state["address"].encode()
+            self.frame = bytearray(b"YsA0000000" + address + b"\n")
+            self.frame_checksum = CHAR_CHECKSUM[ord("A")] ^ CHAR_CHECKSUM[ord("0")]
+            for char in address:
+                self.frame_checksum ^= CHAR_CHECKSUM[char]
+
+        def encode(self, command_code):
+            """Frame for a command code with the current key and rolling code"""
+            frame = self.frame
+            key = self.state["enc_key"]
+            high, low = divmod(self.state["rolling_code"], 256)
+            frame[3] = HEX_DIGITS[key]
+            frame[4] = HEX_DIGITS[command_code]
+            frame[5] = HEX_DIGITS[
+                self.frame_checksum ^ DIGIT_CHECKSUM[key] ^ DIGIT_CHECKSUM[command_code]
+                ^ BYTE_CHECKSUM[high] ^ BYTE_CHECKSUM[low]
+            ]
+            frame[6:8] = HEX_BYTES[high]
+            frame[8:10] = HEX_BYTES[low]
+            return bytes(frame)
+
+        def save(self, state=None):
+            """Atomically save state to JSON file, surviving a power cut"""
+            tmpfile = self.statefile + ".tmp"
+            with open(tmpfile, "w", encoding='utf8') as file_handle:
+                json.dump(state or self.state, file_handle)
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+            os.replace(tmpfile, self.statefile)
+            dir_fd = os.open(os.path.dirname(self.statefile), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        def reserve(self):
+            """Persist that the next block of rolling codes may be in use"""
+            state = dict(self.state)
+            state["rolling_code"] = (self.state["rolling_code"] + self.block_size) % 0x10000
+            state["enc_key"] = (self.state["enc_key"] + self.block_size) % 0x10
+            self.save(state)
+            self.reserved = state["rolling_code"]
+
+        def ensure_reserved(self, count=2):
+            """
+            Reserve the next block now if fewer than count codes are left,
+            so that the file is not written while frames are being sent
+            """
+            with self.lock:
+                if (self.reserved - self.state["rolling_code"]) % 0x10000 < count:
+                    self.reserve()
 
         def increase_rolling_code(self):
             """
             Increment rolling_code, roll over when crossing the 16 bit boundary.
             Increment enc_key, roll over when crossing the 4 bit boundary.
-            Save updated state to statefile
+            Reserve the next block of codes when the current one is used up.
             """
-            self.state["rolling_code"] = (self.state["rolling_code"] + 1) % 0x10000
-            self.state["enc_key"]      = (self.state["enc_key"] + 1) % 0x10
-            self.save()
+            with self.lock:
+                if self.state["rolling_code"] == self.reserved:
+                    self.reserve()
+                self.state["rolling_code"] = (self.state["rolling_code"] + 1) % 0x10000
+                self.state["enc_key"]      = (self.state["enc_key"] + 1) % 0x10
+                if self.state["rolling_code"] == self.reserved:
+                    self.reserve()
+
+    COMMANDS = {
+        "my": 1,
+        "up": 2,
+        "my-up": 3,
+        "down": 4,
+        "my-down": 5,
+        "up-down": 6,
+        "my-up-down": 7,
+        "prog": 8,
+        "enable-sun": 9,
+        "disable-sun": 10,
+    }
+
+    # MQTT payloads and the commands they send
+    PAYLOAD_COMMANDS = {"OPEN": "up", "CLOSE": "down", "STOP": "my", "PROG": "prog"}
 
-    def __init__(self, cul, mqtt_client, prefix, statedir):
+    def __init__(self, cul, mqtt_client, prefix, statedir, config=None, discovery=None):
         self.cul = cul
+        self.discovery = discovery or DiscoveryManager(mqtt_client)
         self.prefix = prefix
 
-        self.devices = []
-        for statefile in os.listdir(statedir + "/somfy/"):
-            if ".json" in statefile:
-                self.devices.append(self.SomfyShutterState(statedir, statefile))
+        self.statedir = statedir
+        self.devices = DeviceRegistry()
+        self.groups = {}
+        self.reload(config)
 
-        for device in self.devices:
+    def reload(self, config):
+        """
+        Add devices of new state files and remove those whose state file is
+        gone, and update the groups. Devices that were already known keep
+        their state in memory.
+        """
+        config = config or {}
+        block_size = int(config.get("rolling_code_block", 16))
+
+        statefiles = set()
+        for statefile in sorted(os.listdir(self.statedir + "/somfy/")):
+            if statefile.endswith(".json"):
+                statefiles.add(self.statedir + "/somfy/" + statefile)
+        known = {device.statefile for device in self.devices}
+        for device in list(self.devices):
+            if device.statefile not in statefiles:
+                logging.info("Removing Somfy device %s", device.state["address"])
+                self.devices.remove(device.state["address"])
+                self.discovery.remove(self.prefix + "/cover/somfy/" + device.state["address"] + "/config")
+        for statefile in sorted(statefiles - known):
+            device = self.SomfyShutterState(self.statedir, os.path.basename(statefile), block_size)
+            self.devices.add(device.state["address"], device)
             # send messages for device discovery
-            self.send_discovery(device, mqtt_client)
+            self.send_discovery(device)
+
+        # groups of devices controlled together, from group_<name> = addresses
+        groups = {}
+        for option in config:
+            if option.startswith("group_"):
+                addresses = [a.strip() for a in config[option].split(",") if a.strip()]
+                unknown = [a for a in addresses if self.devices.get(a) is None]
+                if unknown:
+                    logging.warning("Ignoring unknown devices in Somfy %s: %s", option, unknown)
+                groups[option[6:]] = [self.devices.get(a) for a in addresses if a not in unknown]
+        for name in self.groups:
+            if name not in groups:
+                self.discovery.remove(self.prefix + "/cover/somfy_group/" + name + "/config")
+        self.groups = groups
+        for name in self.groups:
+            self.send_group_discovery(name)
 
     @classmethod
     def get_component_name(cls):
         return "somfy"
 
-    def send_discovery(self, device, mqtt_client):
+    @classmethod
+    def create(cls, cul, publisher, prefix, statedir, config, discovery):
+        return cls(cul, publisher, prefix, statedir, config, discovery)
+
+    def send_discovery(self, device):
         """
         Send Home Assistant - compatible discovery messages
 
@@ -83,7 +230,25 @@ class SomfyShutter:
         }
 
         topic = base_path + "/config"
-        mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
+        self.discovery.announce(topic, configuration)
+
+    def send_group_discovery(self, name):
+        """Send discovery message for a group of devices, as one cover"""
+        base_path = self.prefix + "/cover/somfy_group/" + name
+        device_classes = {device.state["device_class"] for device in self.groups[name]}
+        configuration = {
+            "~": base_path,
+            "command_topic": "~/set",
+            "payload_open": "OPEN",
+            "payload_close": "CLOSE",
+            "payload_stop": "STOP",
+            "optimistic": True,
+            "name": "Somfy " + name,
+            "unique_id": "somfy_group_" + name,
+        }
+        if len(device_classes) == 1:
+            configuration["device_class"] = device_classes.pop()
+        self.discovery.announce(base_path + "/config", configuration)
 
     def calculate_checksum(self, command):
         """
@@ -110,19 +275,11 @@ class SomfyShutter:
         0 - Checksum (set to 0 for calculating checksum)
         RRRR - Rolling code
         SSSSSS - Address (= remote channel)
+
+        This is the reference for SomfyShutterState.encode, which is used
+        for sending.
         """
-        commands = {
-            "my": 1,
-            "up": 2,
-            "my-up": 3,
-            "down": 4,
-            "my-down": 5,
-            "up-down": 6,
-            "my-up-down": 7,
-            "prog": 8,
-            "enable-sun": 9,
-            "disable-sun": 10,
-        }
+        commands = self.COMMANDS
         if command in commands:
             command_string = "A{:01X}{:01X}0{:04X}{}".format(
                 device.state["enc_key"],
@@ -141,41 +298,141 @@ class SomfyShutter:
         return command_string.encode()
 
     def send_command(self, command, device):
-        """Send command string via CUL device"""
-        command_string = self.command_string(command, device)
-        logging.info("sending command string %s to %s", command_string, device.state["name"])
-        self.cul.send_command(command_string)
-        device.increase_rolling_code()
+        """
+        Send command string via CUL device
+
+        The frame is built when the CUL sends it, so that a newer command
+        for the same device replaces one that has not been sent yet, without
+        using up a rolling code.
+        """
+        if command not in self.COMMANDS:
+            raise NameError("unknown command")
+        address = device.state["address"]
+
+        def build():
+            command_string = device.encode(self.COMMANDS[command])
+            device.increase_rolling_code()
+            logging.info("sending command string %s to %s", command_string, device.state["name"])
+            return command_string
+
+        device.ensure_reserved()
+        metrics.inc("commands_sent", protocol="somfy", device=address)
+        # covers take precedence over bulk switch scenes if air time is short
+        return self.cul.route(address).send_command(
+            build, priority=cul.PRIORITY_HIGH, key=("somfy", address), prefix=b"Ys"
+        )
+
+    def get_topic_filters(self):
+        """MQTT topic filters handled by this component, with their handlers"""
+        return {
+            self.prefix + "/cover/somfy/+/set": self.on_message,
+            self.prefix + "/cover/somfy_group/+/set": self.on_group_message,
+        }
+
+    def get_rf_handlers(self):
+        # no RF messages are received, commands are fire-and-forget
+        return {}
 
-    def on_message(self, message):
-        prefix, devicetype, component, address, topic = message.topic.rsplit("/", 4)
+    def on_message(self, message, address):
         command = message.payload.decode()
 
-        if prefix != self.prefix:
-            logging.info("Ignoring message due to prefix")
-            return
-        if devicetype != "cover":
-            raise ValueError("Somfy can only handle covers")
-        if component != "somfy":
-            raise ValueError("Received command for different component")
-
-        device = None
-        for d in self.devices:
-            if d.state["address"] == address:
-                device = d
+        device = self.devices.get(address)
         if not device:
             raise ValueError("Device not found: %s", address)
 
-        if topic == "set":
-            if command == "OPEN":
-                self.send_command("up", device)
-            elif command == "CLOSE":
-                self.send_command("down", device)
-            elif command == "STOP":
-                self.send_command("my", device)
-            elif command == "PROG":
-                self.send_command("prog", device)
-            else:
-                raise ValueError("Command %s is not supported", command)
-        else:
-            logging.debug("ignoring topic %s", topic)
+        if command not in self.PAYLOAD_COMMANDS:
+            raise ValueError("Command %s is not supported", command)
+        self.send_command(self.PAYLOAD_COMMANDS[command], device)
+
+    def on_group_message(self, message, name):
+        command = message.payload.decode()
+
+        devices = self.groups.get(name)
+        if devices is None:
+            raise ValueError("Group not found: %s", name)
+        # pairing is only possible with a single device
+        if command not in self.PAYLOAD_COMMANDS or command == "PROG":
+            raise ValueError("Command %s is not supported for groups", command)
+
+        # reserve rolling codes up front, then queue all frames back-to-back,
+        # so that they are sent in as few bursts as the duty cycle allows
+        for device in devices:
+            device.ensure_reserved()
+        return [self.send_command(self.PAYLOAD_COMMANDS[command], device) for device in devices]
+
+
+def test_rolling_code_reservation(tmp_path):
+    import pathlib
+
+    from ..testing import write_somfy_state
+
+    statefile = pathlib.Path(write_somfy_state(tmp_path, "B0C004", 0xFFF8, filename="shutter.json"))
+    for _ in range(3):
+        device = SomfyShutter.SomfyShutterState(str(tmp_path), "shutter.json", block_size=16)
+    # restarts without button presses reserve nothing
+    assert json.loads(statefile.read_text())["rolling_code"] == 0xFFF8
+    device.ensure_reserved()
+    assert json.loads(statefile.read_text())["rolling_code"] == 0x0008
+    for _ in range(15):
+        device.increase_rolling_code()
+    # no disk I/O within the reserved block
+    assert json.loads(statefile.read_text())["rolling_code"] == 0x0008
+    device.increase_rolling_code()
+    assert device.state["rolling_code"] == 0x0008
+    assert json.loads(statefile.read_text())["rolling_code"] == 0x0018
+    # after a crash, sending resumes behind the reserved block
+    restarted = SomfyShutter.SomfyShutterState(str(tmp_path), "shutter.json", block_size=16)
+    assert restarted.state["rolling_code"] == 0x0018
+    assert restarted.state["enc_key"] == device.state["enc_key"]
+
+
+def test_encode(tmp_path):
+    import random
+
+    from ..testing import write_somfy_state
+
+    write_somfy_state(tmp_path, "B0C004", 0)
+    somfy = SomfyShutter(cul.Cul("", test=True), None, "homeassistant", str(tmp_path))
+    device = somfy.devices.get("B0C004")
+    rng = random.Random(0)
+    for _ in range(2000):
+        device.state["address"] = "%06X" % rng.randrange(0x1000000)
+        device.build_frame()
+        device.state["enc_key"] = rng.randrange(16)
+        device.state["rolling_code"] = rng.randrange(0x10000)
+        command = rng.choice(list(SomfyShutter.COMMANDS))
+        assert device.encode(SomfyShutter.COMMANDS[command]) == somfy.command_string(command, device)
+
+
+def test_reload(tmp_path):
+    from ..testing import RecordingPublisher, write_somfy_state
+
+    for address in ("B0C004", "B0C005"):
+        write_somfy_state(tmp_path, address)
+    discovery = DiscoveryManager(RecordingPublisher())
+    somfy = SomfyShutter(None, None, "ha", str(tmp_path), {"group_all": "B0C004, B0C005"}, discovery)
+    device = somfy.devices.get("B0C004")
+    device.increase_rolling_code()
+    (tmp_path / "somfy" / "B0C005.json").unlink()
+    write_somfy_state(tmp_path, "B0C006")
+    somfy.reload({})
+    assert set(discovery.configs) == {"ha/cover/somfy/B0C004/config", "ha/cover/somfy/B0C006/config"}
+    # known devices keep their state
+    assert somfy.devices.get("B0C004") is device
+    assert device.state["rolling_code"] == 0x0011
+
+
+def test_group(tmp_path):
+    from ..testing import HeldWriter, Message, write_somfy_state
+
+    for address in ("B0C004", "B0C005"):
+        write_somfy_state(tmp_path, address)
+    cul_device = cul.Cul("", test=True)
+    writer = HeldWriter(cul_device)
+    somfy = SomfyShutter(cul_device, None, "homeassistant", str(tmp_path), {"group_all": "B0C004, B0C005"})
+    somfy.on_group_message(Message(b"OPEN"), "all")
+    futures = somfy.on_group_message(Message(b"CLOSE"), "all")
+    assert len(futures) == 2
+    # only CLOSE is sent, using the next rolling code of each device
+    assert writer.release(2) == [b"YsA1470010B0C004\n", b"YsA1460010B0C005\n"]
+    assert somfy.devices.get("B0C004").state["rolling_code"] == 0x0011
@@ -0,0 +1,195 @@
+"""
+Outbound MQTT publish stage
+
+Messages are handed to a Publisher, which publishes them from its own thread,
+so that the RF receive path never blocks on the MQTT client. While the broker
+is unreachable, messages are held back according to their policy:
+
+- POLICY_LATEST: only the latest message per topic is kept (sensor state).
+  If too many topics are pending, the oldest one is dropped.
+- POLICY_RELIABLE: messages are never dropped (discovery, command acks).
+- POLICY_SPOOL: sensor readings. While the broker is unreachable, they are
+  appended to a disk spool with their receive time, and published in order,
+  at most spool_rate per second, after reconnecting. Without spool, like
+  POLICY_LATEST.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+
+POLICY_LATEST = "latest"
+POLICY_RELIABLE = "reliable"
+POLICY_SPOOL = "spool"
+
+
+class Publisher:
+    """Bounded queue of messages to publish, drained by a dedicated thread"""
+
+    def __init__(self, mqtt_client, max_pending=1000, spool=None, spool_rate=20):
+        self.mqtt_client = mqtt_client
+        self.max_pending = max_pending
+        self.spool = spool
+        self.spool_rate = spool_rate
+        # spool segment being published and its remaining records
+        self.draining = None
+        self.next_drain = 0
+
+        self.condition = threading.Condition()
+        # topic -> (payload, qos, retain), in order of first arrival
+        self.latest = collections.OrderedDict()
+        self.reliable = collections.deque()
+
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, policy=None):
+        """
+        Queue a message for publishing, same arguments as paho's publish
+
+        Without explicit policy, retained messages are never dropped and
+        other messages use latest-value-wins.
+        """
+        if policy is None:
+            policy = POLICY_RELIABLE if retain else POLICY_LATEST
+        if policy == POLICY_SPOOL:
+            # keep the order: while spooled messages are pending, spool new ones
+            if self.spool and (self.spool.pending() or not self.mqtt_client.is_connected()):
+                self.spool.append(topic, self.timestamped(payload))
+                return
+            policy = POLICY_LATEST
+        message = (topic, payload, qos, retain)
+        with self.condition:
+            if policy == POLICY_RELIABLE:
+                self.reliable.append(message)
+            elif topic in self.latest:
+                self.latest[topic] = message
+                self.coalesced += 1
+            else:
+                if len(self.latest) >= self.max_pending:
+                    dropped, _ = self.latest.popitem(last=False)
+                    self.dropped += 1
+                    logging.warning("Publish queue full, dropping message for %s", dropped)
+                self.latest[topic] = message
+            self.condition.notify()
+
+    @staticmethod
+    def timestamped(payload):
+        """Add the current time to a JSON object payload"""
+        try:
+            state = json.loads(payload)
+        except (TypeError, ValueError):
+            return payload
+        if not isinstance(state, dict):
+            return payload
+        state.setdefault("timestamp", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+        return json.dumps(state)
+
+    def spool_due(self):
+        return self.spool is not None and self.spool.pending() and time.monotonic() >= self.next_drain
+
+    def wake(self):
+        """Resume publishing, e.g. after the MQTT client (re)connected"""
+        with self.condition:
+            self.condition.notify()
+
+    def take(self):
+        """Wait until messages can be published and take all pending ones"""
+        with self.condition:
+            while not (self.reliable or self.latest or self.spool_due()) or not self.mqtt_client.is_connected():
+                self.condition.wait(timeout=1)
+            messages = list(self.reliable)
+            self.reliable.clear()
+            messages.extend(self.latest.values())
+            self.latest.clear()
+        return messages
+
+    def run(self):
+        while True:
+            for topic, payload, qos, retain in self.take():
+                self.mqtt_client.publish(topic, payload=payload, qos=qos, retain=retain)
+                self.published += 1
+            if self.spool_due():
+                self.drain_spool()
+
+    def drain_spool(self):
+        """Publish the next spool_rate spooled messages"""
+        if self.draining is None:
+            self.draining = self.spool.take()
+        number, records = self.draining
+        for i, (topic, payload) in enumerate(records[0:self.spool_rate]):
+            if not self.mqtt_client.is_connected():
+                # keep the rest for the next connection
+                self.spool.done(number, records[i:])
+                self.draining = None
+                return
+            self.mqtt_client.publish(topic, payload=payload)
+            self.published += 1
+        records = records[self.spool_rate:]
+        if records:
+            self.draining = (number, records)
+        else:
+            self.spool.done(number, [])
+            self.draining = None
+        self.next_drain = time.monotonic() + 1
+
+    def metrics(self):
+        """Queue depths and counters as a dict"""
+        with self.condition:
+            return {
+                "pending_latest": len(self.latest),
+                "pending_reliable": len(self.reliable),
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "spool": self.spool.metrics() if self.spool else None,
+            }
+
+
+def test_publisher():
+    from .testing import RecordingPublisher
+
+    publisher = Publisher(RecordingPublisher(connected=False), max_pending=2)
+    publisher.publish("a/config", "{}", retain=True)
+    publisher.publish("a/state", "1")
+    publisher.publish("a/state", "2")
+    publisher.publish("b/state", "1")
+    publisher.publish("c/state", "1")
+    metrics = publisher.metrics()
+    assert metrics["pending_reliable"] == 1
+    assert metrics["pending_latest"] == 2
+    assert metrics["coalesced"] == 1
+    assert metrics["dropped"] == 1
+    assert list(publisher.latest) == ["b/state", "c/state"]
+
+
+def test_spool(tmp_path):
+    from .spool import Spool
+    from .testing import RecordingPublisher
+
+    client = RecordingPublisher(connected=False)
+    publisher = Publisher(client, spool=Spool(str(tmp_path), 10000), spool_rate=2)
+    for i in range(3):
+        publisher.publish("a/state", json.dumps({"i": i}), policy=POLICY_SPOOL)
+    assert publisher.spool.pending() and not publisher.latest
+    client.connected = True
+    # new readings are queued behind the spooled ones
+    publisher.publish("a/state", json.dumps({"i": 3}), policy=POLICY_SPOOL)
+    publisher.wake()
+    deadline = time.monotonic() + 3
+    while len(client.published) < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    states = client.payloads()
+    assert [state["i"] for state in states] == [0, 1, 2, 3]
+    assert "timestamp" in states[0] and "timestamp" in states[3]
+    # once the spool is drained, readings are published directly
+    publisher.publish("a/state", json.dumps({"i": 4}), policy=POLICY_SPOOL)
+    while len(client.published) < 5 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert client.published[4] == ("a/state", json.dumps({"i": 4}))
@@ -0,0 +1,53 @@
+"""
+Registry of the devices known to a protocol
+
+Devices are keyed by their address or sensor id for O(1) lookup on every
+command and every received RF frame. Iteration yields devices in the order
+they were added, so that discovery messages are sent in a stable order.
+"""
+
+
+class DeviceRegistry:
+    """Devices of a protocol, keyed by address or sensor id"""
+
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, key, device):
+        """Add device, replacing any device with the same key"""
+        self.devices[key] = device
+        return device
+
+    def get(self, key, default=None):
+        return self.devices.get(key, default)
+
+    def remove(self, key):
+        """Remove and return device, or None if unknown"""
+        return self.devices.pop(key, None)
+
+    def keys(self):
+        return self.devices.keys()
+
+    def __contains__(self, key):
+        return key in self.devices
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __repr__(self):
+        return "DeviceRegistry(%s)" % ", ".join(str(key) for key in self.devices)
+
+
+def test_registry():
+    registry = DeviceRegistry()
+    registry.add("B0C004", "kitchen")
+    registry.add("B0C001", "bath")
+    assert "B0C004" in registry
+    assert registry.get("B0C001") == "bath"
+    assert registry.get("000000") is None
+    assert list(registry) == ["kitchen", "bath"]
+    assert registry.remove("B0C004") == "kitchen"
+    assert len(registry) == 1
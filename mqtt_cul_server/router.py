@@ -0,0 +1,111 @@
+"""
+Route MQTT messages to the handlers of the topic filters they match
+
+Components declare the topic filters they handle, e.g.
+"homeassistant/cover/somfy/+/set". The server subscribes to exactly these
+filters, and the router finds the handler for a received topic by walking a
+trie of topic levels. The topic levels matched by wildcards are passed to
+the handler, so that it doesn't need to split the topic again.
+"""
+
+
+class TopicRouter:
+    """Trie of MQTT topic filters supporting "+" and "#" wildcards"""
+
+    class Node:
+        __slots__ = ("children", "handler")
+
+        def __init__(self):
+            self.children = {}
+            self.handler = None
+
+    def __init__(self):
+        self.root = self.Node()
+        # filters without wildcards are looked up directly
+        self.exact = {}
+        self.handlers = {}
+
+    def add(self, topic_filter, handler):
+        """Register a handler for a topic filter"""
+        self.handlers[topic_filter] = handler
+        if "+" not in topic_filter and "#" not in topic_filter:
+            self.exact[topic_filter] = handler
+            return
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, self.Node())
+        node.handler = handler
+
+    def remove(self, topic_filter):
+        """Unregister the handler of a topic filter"""
+        self.handlers.pop(topic_filter, None)
+        if self.exact.pop(topic_filter, None) is not None:
+            return
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return
+        node.handler = None
+
+    def filters(self):
+        """All registered topic filters"""
+        return list(self.handlers)
+
+    def route(self, topic):
+        """
+        Find the handler for a topic
+
+        Returns a tuple (handler, fields) with the topic levels matched by
+        wildcards, or (None, None) if no filter matches.
+        """
+        handler = self.exact.get(topic)
+        if handler is not None:
+            return handler, ()
+        return self.match(self.root, topic.split("/"), 0, ())
+
+    def match(self, node, levels, index, fields):
+        if index == len(levels):
+            if node.handler is not None:
+                return node.handler, fields
+            # "a/#" also matches "a"
+            node = node.children.get("#")
+            if node is not None and node.handler is not None:
+                return node.handler, fields
+            return None, None
+        level = levels[index]
+        child = node.children.get(level)
+        if child is not None:
+            handler, matched = self.match(child, levels, index + 1, fields)
+            if handler is not None:
+                return handler, matched
+        child = node.children.get("+")
+        if child is not None:
+            handler, matched = self.match(child, levels, index + 1, fields + (level,))
+            if handler is not None:
+                return handler, matched
+        child = node.children.get("#")
+        if child is not None and child.handler is not None:
+            return child.handler, fields + ("/".join(levels[index:]),)
+        return None, None
+
+
+def test_router():
+    router = TopicRouter()
+    router.add("homeassistant/cover/somfy/+/set", "somfy")
+    router.add("homeassistant/switch/intertechno/+/set", "intertechno")
+    router.add("homeassistant/status", "status")
+    router.add("debug/#", "debug")
+    assert router.route("homeassistant/cover/somfy/B0C004/set") == ("somfy", ("B0C004",))
+    assert router.route("homeassistant/switch/intertechno/0F0FF0FFFF/set") == (
+        "intertechno", ("0F0FF0FFFF",)
+    )
+    assert router.route("homeassistant/status") == ("status", ())
+    assert router.route("debug/a/b") == ("debug", ("a/b",))
+    assert router.route("homeassistant/cover/somfy/B0C004/config") == (None, None)
+    assert router.route("homeassistant/sensor/lacrosse/7/state") == (None, None)
+    router.remove("homeassistant/cover/somfy/+/set")
+    assert router.route("homeassistant/cover/somfy/B0C004/set") == (None, None)
+    assert sorted(router.filters()) == [
+        "debug/#", "homeassistant/status", "homeassistant/switch/intertechno/+/set"
+    ]
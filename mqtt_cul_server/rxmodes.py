@@ -0,0 +1,147 @@
+"""
+Time-sliced receive modes
+
+A CUL listens in one native receive mode at a time, e.g. Nr1 for 17.241
+kbps and Nr2 for 9.579 kbps LaCrosse IT+ sensors. To hear sensors of several
+modes with one CUL, the scheduler cycles through the configured modes. Each
+mode gets a minimum slice, the rest of the cycle is shared in proportion to
+the rate of lines received in each mode. Lines received in native mode k
+start with "N0k", so hits are counted per mode by their prefix.
+"""
+
+import logging
+import threading
+import time
+
+from . import metrics
+
+
+class ReceiveModeScheduler:
+    """Switch the receive mode of a CUL between several native modes"""
+
+    # weight of the last slice in the smoothed hit rates
+    SMOOTHING = 0.3
+
+    def __init__(self, cul, modes, min_dwell=10, cycle=60):
+        self.cul = cul
+        self.modes = list(modes)
+        self.min_dwell = min_dwell
+        self.cycle = max(cycle, min_dwell * len(self.modes))
+        # line prefix -> index of the mode
+        self.prefixes = {self.line_prefix(mode): i for i, mode in enumerate(self.modes)}
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.current = None
+        self.hits = [0] * len(self.modes)
+        self.total_hits = [0] * len(self.modes)
+        self.listened = [0.0] * len(self.modes)
+        # smoothed hits per second of each mode
+        self.rates = [0.0] * len(self.modes)
+
+    @staticmethod
+    def line_prefix(mode):
+        """Prefix of lines received in a native mode, e.g. Nr2 -> N02"""
+        return b"N%02d" % int(mode[2:])
+
+    def on_rf_message(self, message):
+        """Count a received line as hit of its mode"""
+        index = self.prefixes.get(message[0:3])
+        if index is not None:
+            with self.lock:
+                self.hits[index] += 1
+
+    def dwell(self, index):
+        """Seconds to listen in a mode during one cycle"""
+        total = sum(self.rates)
+        spare = self.cycle - self.min_dwell * len(self.modes)
+        if not total:
+            return self.min_dwell + spare / len(self.modes)
+        return self.min_dwell + spare * self.rates[index] / total
+
+    def end_slice(self, index, duration):
+        """Update the hit rate of a mode after listening for duration seconds"""
+        with self.lock:
+            hits = self.hits[index]
+            self.hits[index] = 0
+            self.total_hits[index] += hits
+            self.listened[index] += duration
+            rate = hits / duration if duration else 0
+            self.rates[index] += self.SMOOTHING * (rate - self.rates[index])
+
+    def run(self):
+        while True:
+            for index, mode in enumerate(self.modes):
+                dwell = self.dwell(index)
+                self.current = mode
+                # also the mode the CUL returns to after transmitting
+                self.cul.set_receive_mode(mode.encode() + b"\n")
+                start = time.monotonic()
+                if self.stopped.wait(dwell):
+                    return
+                self.end_slice(index, time.monotonic() - start)
+            logging.debug("receive mode hit rates: %s", self.metrics())
+
+    def start(self):
+        """Start switching modes, reporting the hit rates while running"""
+        for mode in self.modes:
+            metrics.register_gauge(
+                "rx_mode_hits_per_minute", lambda mode=mode: self.metrics()[mode]["hits_per_minute"], mode=mode
+            )
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop switching modes, the CUL stays in the current one"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        for mode in self.modes:
+            metrics.unregister_gauge("rx_mode_hits_per_minute", mode=mode)
+
+    def metrics(self):
+        """Hits and share of listening time per mode"""
+        with self.lock:
+            listened = sum(self.listened)
+            return {
+                mode: {
+                    "hits": self.total_hits[i],
+                    "hits_per_minute": round(60 * self.total_hits[i] / self.listened[i], 2) if self.listened[i] else 0,
+                    "share": round(self.listened[i] / listened, 2) if listened else 0,
+                }
+                for i, mode in enumerate(self.modes)
+            }
+
+
+def test_receive_mode_scheduler():
+    scheduler = ReceiveModeScheduler(None, ["Nr1", "Nr2"], min_dwell=10, cycle=60)
+    assert scheduler.line_prefix("Nr2") == b"N02"
+    assert scheduler.dwell(0) == scheduler.dwell(1) == 30
+    for _ in range(30):
+        scheduler.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    scheduler.on_rf_message(b"N029986373FC9AAAA0000000783")
+    scheduler.on_rf_message(b"OK")
+    scheduler.end_slice(0, 30)
+    scheduler.end_slice(1, 30)
+    # the busier mode gets more time, but every mode keeps its minimum
+    assert scheduler.dwell(0) > 40 and scheduler.dwell(1) >= 10
+    assert scheduler.dwell(0) + scheduler.dwell(1) == 60
+    assert scheduler.metrics()["Nr1"] == {"hits": 30, "hits_per_minute": 60, "share": 0.5}
+    assert scheduler.metrics()["Nr2"]["hits"] == 1
+
+
+def test_scheduler_gauges():
+    from .cul import Cul
+
+    def gauges():
+        return {key for key in metrics.collect_gauges() if key[0] == "rx_mode_hits_per_minute"}
+
+    scheduler = ReceiveModeScheduler(Cul("", test=True), ["Nr1", "Nr2"])
+    # gauges are only reported while the scheduler runs, so that a scheduler
+    # replaced on reload does not keep reporting
+    assert gauges() == set()
+    scheduler.start()
+    assert gauges() == {("rx_mode_hits_per_minute", (("mode", mode),)) for mode in ("Nr1", "Nr2")}
+    scheduler.stop()
+    assert gauges() == set()
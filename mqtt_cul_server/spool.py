@@ -0,0 +1,157 @@
+"""
+Store-and-forward spool of messages on disk
+
+While the broker is unreachable, messages are appended as JSON lines to
+segment files spool.<n> in the spool directory. The total size is capped: if
+there are more than SEGMENTS segments, the oldest one is dropped. After
+reconnecting, segments are taken oldest first and published, while newer
+messages keep being appended to a new segment, so the order is preserved.
+Spooled messages survive restarts of the bridge.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+SEGMENT_NAME = re.compile(r"spool\.(\d+)")
+
+
+class Spool:
+    """Size-capped, append-only message log split into segment files"""
+
+    # number of segments the size limit is split into
+    SEGMENTS = 4
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.segment_size = max(1, max_bytes // self.SEGMENTS)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # numbers of the segment files, oldest first
+        self.segments = sorted(
+            int(match.group(1)) for match in map(SEGMENT_NAME.fullmatch, os.listdir(directory)) if match
+        )
+        # segment appended to, and its file
+        self.current = None
+        self.file = None
+
+        self.spooled = 0
+        self.dropped = 0
+
+    def path(self, number):
+        return "%s/spool.%d" % (self.directory, number)
+
+    def pending(self):
+        """Whether messages are waiting to be published"""
+        return bool(self.segments)
+
+    def append(self, topic, payload):
+        line = json.dumps([topic, payload], separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.file is None:
+                self.current = self.segments[-1] + 1 if self.segments else 0
+                self.segments.append(self.current)
+                self.file = open(self.path(self.current), "a", encoding="utf8")
+                while len(self.segments) > self.SEGMENTS:
+                    self.drop(self.segments[0])
+            self.file.write(line)
+            self.file.flush()
+            self.spooled += 1
+            if self.file.tell() >= self.segment_size:
+                self.close()
+
+    def close(self):
+        """Close the current segment, the next append starts a new one"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.current = None
+
+    def drop(self, number):
+        self.segments.remove(number)
+        try:
+            with open(self.path(number), encoding="utf8") as file_handle:
+                count = sum(1 for _ in file_handle)
+            os.remove(self.path(number))
+        except FileNotFoundError:
+            count = 0
+        self.dropped += count
+        logging.warning("Spool full, dropped %d oldest messages", count)
+
+    def take(self):
+        """Oldest segment number and its [topic, payload] records, or None"""
+        with self.lock:
+            if not self.segments:
+                return None
+            number = self.segments[0]
+            if number == self.current:
+                self.close()
+            records = []
+            try:
+                with open(self.path(number), encoding="utf8") as file_handle:
+                    for line in file_handle:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # the last line may be cut off by a crash
+                            logging.warning("Skipping invalid spool line %r", line)
+            except FileNotFoundError:
+                pass
+            return number, records
+
+    def done(self, number, remaining):
+        """Remove a taken segment, or keep the records not published yet"""
+        with self.lock:
+            if number not in self.segments:
+                # dropped in the meantime
+                return
+            if not remaining:
+                self.segments.remove(number)
+                try:
+                    os.remove(self.path(number))
+                except FileNotFoundError:
+                    pass
+                return
+            path = self.path(number)
+            with open(path + ".tmp", "w", encoding="utf8") as file_handle:
+                for record in remaining:
+                    file_handle.write(json.dumps(record, separators=(",", ":")) + "\n")
+            os.replace(path + ".tmp", path)
+
+    def metrics(self):
+        with self.lock:
+            return {"segments": len(self.segments), "spooled": self.spooled, "dropped": self.dropped}
+
+
+def test_spool(tmp_path):
+    spool = Spool(str(tmp_path), 400)
+    assert not spool.pending()
+    for i in range(20):
+        spool.append("a/state", '{"i": %d}' % i)
+    # the oldest segments were dropped to stay within the size limit
+    assert spool.pending()
+    assert len(spool.segments) == Spool.SEGMENTS
+    assert spool.dropped > 0
+
+    # segments survive a restart and are taken oldest first
+    spool.close()
+    spool = Spool(str(tmp_path), 400)
+    number, records = spool.take()
+    # partially published, the rest is taken again, before newer messages
+    received = records[0:1]
+    spool.done(number, records[1:])
+    assert spool.take() == (number, records[1:])
+    received.extend(records[1:])
+    spool.done(number, [])
+    spool.append("a/state", "new")
+    while spool.pending():
+        number, records = spool.take()
+        received.extend(records)
+        spool.done(number, [])
+    payloads = [payload for _, payload in received]
+    assert payloads[-1] == "new"
+    numbers = [json.loads(payload)["i"] for payload in payloads[:-1]]
+    assert numbers == list(range(numbers[0], 20))
+    assert os.listdir(str(tmp_path)) == []
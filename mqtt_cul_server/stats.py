@@ -0,0 +1,80 @@
+"""
+Rolling statistics of sensor readings
+
+Each series keeps one bucket per minute in a fixed-size ring of arrays, so
+memory per series is constant. Adding a reading only updates the bucket of
+the current minute; aggregates over any window up to the ring size are
+computed from the buckets when they are published.
+"""
+
+import array
+import math
+
+# name and length in minutes of the published windows
+WINDOWS = (("5m", 5), ("1h", 60), ("24h", 1440))
+
+# minute of buckets that were never used
+UNUSED = -2 ** 63
+
+
+class RollingStats:
+    """Min, max and mean of a series over the last minutes"""
+
+    __slots__ = ("size", "minutes", "counts", "sums", "mins", "maxs")
+
+    def __init__(self, size=1440):
+        self.size = size
+        # minute each bucket belongs to
+        self.minutes = array.array("q", [UNUSED]) * size
+        self.counts = array.array("L", [0]) * size
+        self.sums = array.array("d", [0.0]) * size
+        self.mins = array.array("d", [0.0]) * size
+        self.maxs = array.array("d", [0.0]) * size
+
+    def add(self, value, now):
+        """Add a reading taken at now, in seconds"""
+        minute = int(now // 60)
+        slot = minute % self.size
+        if self.minutes[slot] != minute:
+            self.minutes[slot] = minute
+            self.counts[slot] = 1
+            self.sums[slot] = self.mins[slot] = self.maxs[slot] = value
+            return
+        self.counts[slot] += 1
+        self.sums[slot] += value
+        if value < self.mins[slot]:
+            self.mins[slot] = value
+        elif value > self.maxs[slot]:
+            self.maxs[slot] = value
+
+    def aggregate(self, window, now):
+        """(min, max, mean) over the last window minutes, or None if empty"""
+        current = int(now // 60)
+        count = 0
+        total = 0.0
+        low = math.inf
+        high = -math.inf
+        for minute in range(current - min(window, self.size) + 1, current + 1):
+            slot = minute % self.size
+            if self.minutes[slot] != minute:
+                continue
+            count += self.counts[slot]
+            total += self.sums[slot]
+            low = min(low, self.mins[slot])
+            high = max(high, self.maxs[slot])
+        if not count:
+            return None
+        return low, high, total / count
+
+
+def test_rolling_stats():
+    stats = RollingStats(size=60)
+    assert stats.aggregate(5, 0) is None
+    stats.add(20.0, 0)
+    stats.add(22.0, 30)
+    stats.add(21.0, 90)
+    assert stats.aggregate(5, 100) == (20.0, 22.0, 21.0)
+    assert stats.aggregate(1, 100) == (21.0, 21.0, 21.0)
+    # buckets older than the ring are reused
+    stats.add(25.0, 60 * 60)
+    assert stats.aggregate(60, 60 * 60) == (21.0, 25.0, 23.0)
@@ -0,0 +1,74 @@
+"""
+Fakes shared by the tests kept next to the code
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class RecordingPublisher:
+    """
+    Stand-in for a Publisher or a paho client, recording all published
+    (topic, payload) pairs
+    """
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = []
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False, policy=None):
+        self.published.append((topic, payload))
+
+    def payloads(self, suffix=""):
+        """Decoded JSON payloads published to topics ending with suffix"""
+        return [json.loads(payload) for topic, payload in self.published if topic.endswith(suffix)]
+
+
+class HeldWriter:
+    """
+    Records the frames written by a Cul, holding back its writer thread until
+    release(), so that commands can be queued first
+    """
+
+    def __init__(self, cul_device):
+        self.written = []
+        self.gate = threading.Event()
+        cul_device.write_burst = lambda burst: self.written.extend(item[2] for item in burst)
+        cul_device.send_command(lambda: self.gate.wait() and b"")
+        # let the writer thread take the blocking command
+        time.sleep(0.05)
+
+    def release(self, count, timeout=1):
+        """Let the writer go, returns the frames written once there are count of them"""
+        self.gate.set()
+        deadline = time.monotonic() + timeout
+        while len(self.written) < count + 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # without the empty frame of the blocking command
+        return self.written[1:]
+
+
+def write_somfy_state(statedir, address, rolling_code=0x0010, enc_key=1, filename=None):
+    """Write the state file of a Somfy shutter to <statedir>/somfy, returns its path"""
+    directory = os.path.join(str(statedir), "somfy")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename or address + ".json")
+    with open(path, "w", encoding="utf8") as file_handle:
+        json.dump({
+            "name": address, "device_class": "shutter", "address": address,
+            "enc_key": enc_key, "rolling_code": rolling_code,
+        }, file_handle)
+    return path
+
+
+class Message:
+    """Stand-in for a received paho MQTTMessage"""
+
+    def __init__(self, payload, topic=""):
+        self.payload = payload
+        self.topic = topic
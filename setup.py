@@ -7,5 +7,5 @@ setup(name='mqtt_cul_server',
       author='Bernhard Bock',
       author_email='bernhard@bock.nu',
       license='GPL',
-      packages=['mqtt_cul_server'],
+      packages=['mqtt_cul_server', 'mqtt_cul_server.protocols'],
       zip_safe=True)